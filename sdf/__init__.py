@@ -6,17 +6,23 @@ from .d2 import *
 
 from .d3 import *
 
+from .graph import optimize
+
+from .jit import compile
+
 from .mesh import Mesh
 
 from .text import (
     measure_image,
     measure_text,
+    glyph_text,
     image,
     text,
 )
 
 from .core import (
     generate,
+    generate_iter,
     save,
     sample_slice,
     show_slice,
@@ -24,4 +30,5 @@ from .core import (
 
 from .stl import (
     write_binary_stl,
+    BinarySTLWriter,
 )
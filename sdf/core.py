@@ -1,21 +1,30 @@
 from functools import partial
+from multiprocessing import resource_tracker, shared_memory
 from multiprocessing.pool import ThreadPool
 from skimage import measure
 
+import collections
 import multiprocessing
 import itertools
+import numbers
 import numpy as np
+import pickle
+import queue
 import time
 
-from . import progress, stl
+from . import dc, decimate, progress, stl
 
 WORKERS = multiprocessing.cpu_count()
 SAMPLES = 2 ** 22
 BATCH_SIZE = 32
 
+# once fewer batches than workers are waiting, the next ones are split into
+# octants down to SPLIT_SIZE cells on a side, so idle workers can share them
+SPLIT_SIZE = 8
+
 def _marching_cubes(volume, level=0):
     verts, faces, _, _ = measure.marching_cubes(volume, level)
-    return verts[faces].reshape((-1, 3))
+    return verts, faces
 
 def _cartesian_product(*arrays):
     la = len(arrays)
@@ -25,39 +34,290 @@ def _cartesian_product(*arrays):
         arr[...,i] = a
     return arr.reshape(-1, la)
 
-def _skip(sdf, job):
-    X, Y, Z = job
-    x0, x1 = X[0], X[-1]
-    y0, y1 = Y[0], Y[-1]
-    z0, z1 = Z[0], Z[-1]
-    x = (x0 + x1) / 2
-    y = (y0 + y1) / 2
-    z = (z0 + z1) / 2
-    r = abs(sdf(np.array([(x, y, z)])).reshape(-1)[0])
-    d = np.linalg.norm(np.array((x-x0, y-y0, z-z0)))
-    if r <= d:
-        return False
-    corners = np.array(list(itertools.product((x0, x1), (y0, y1), (z0, z1))))
-    values = sdf(corners).reshape(-1)
-    same = np.all(values > 0) if values[0] > 0 else np.all(values < 0)
-    return same
-
-def _worker(sdf, job, step, sparse):
-    X, Y, Z = job
-    if sparse and _skip(sdf, job):
-        return None
-        # return _debug_triangles(X, Y, Z)
+def _interval(sdf, lo, hi):
+    interval = getattr(sdf, 'interval', None)
+    return interval(lo, hi) if interval is not None else None
+
+def _prune(sdf, lo, hi):
+    # drop the parts of the model that can't change it within the batch
+    prune = getattr(sdf, 'prune', None)
+    return prune(lo, hi) if prune is not None else sdf
+
+def _grid(sdf, X, Y, Z):
+    # samples on the grid spanned by X, Y and Z, without building every
+    # point when the model can work on the axes
+    grid = getattr(sdf, 'grid', None)
+    if grid is not None:
+        return np.ascontiguousarray(grid(X, Y, Z))
     P = _cartesian_product(X, Y, Z)
+    return sdf(P).reshape((len(X), len(Y), len(Z)))
+
+def _skip(sdf, grid, batches):
+    # which batches the surface can't pass through, decided for all of them
+    # at once so the model is only called once or twice
+    skip = np.zeros(len(batches), dtype=bool)
+    if not batches:
+        return skip
+    lo = np.array([[a[s.start] for a, s in zip(grid, job)]
+        for job in batches])
+    hi = np.array([[a[min(s.stop, len(a)) - 1] for a, s in zip(grid, job)]
+        for job in batches])
+    # interval bounds never miss the surface, even after warps and smooth
+    # blends, so use them when the whole model supports them
+    i = _interval(sdf, lo, hi)
+    if i is not None:
+        return (i[0].reshape(-1) > 0) | (i[1].reshape(-1) < 0)
+    center = (lo + hi) / 2
+    r = np.abs(sdf(center).reshape(-1))
+    d = np.linalg.norm(center - lo, axis=1)
+    m = np.flatnonzero(r > d)
+    if len(m) == 0:
+        return skip
+    offsets = np.array(list(itertools.product((0, 1), repeat=3)), dtype=bool)
+    corners = np.where(offsets, hi[m,None], lo[m,None]).reshape((-1, 3))
+    values = sdf(corners).reshape((-1, 8))
+    skip[m] = np.where(values[:,0] > 0,
+        np.all(values > 0, axis=1), np.all(values < 0, axis=1))
+    return skip
+
+def _seam_keys(verts, shape, origin, size):
+    # marching cubes vertices lie on grid edges, so every vertex can be
+    # identified by the grid point that starts its edge and the edge axis.
+    # only vertices on the boundary planes of a batch are shared with
+    # neighboring batches, the rest get no key.
+    i = np.floor(verts).astype(int)
+    frac = verts != i
+    axis = np.where(np.any(frac, axis=1), np.argmax(frac, axis=1), 3)
+    seam = np.any(~frac & ((i == 0) | (i == np.array(shape) - 1)), axis=1)
+    index = np.ravel_multi_index((i + origin).T, size)
+    return np.where(seam, index * 4 + axis, -1)
+
+def _worker(sdf, grid, job, indexed, method):
+    X, Y, Z = (a[s] for a, s in zip(grid, job))
+    if method == 'dual_contouring':
+        return _dual_worker(sdf, grid, job, indexed)
+    sdf = _prune(sdf, (X[0], Y[0], Z[0]), (X[-1], Y[-1], Z[-1]))
     shape = (len(X), len(Y), len(Z))
-    volume = sdf(P).reshape(shape)
+    volume = _grid(sdf, X, Y, Z)
     try:
-        points = _marching_cubes(volume)
+        verts, faces = _marching_cubes(volume)
     except Exception:
         return []
         # return _debug_triangles(X, Y, Z)
     scale = np.array([X[1] - X[0], Y[1] - Y[0], Z[1] - Z[0]])
     offset = np.array([X[0], Y[0], Z[0]])
-    return points * scale + offset
+    if not indexed:
+        return verts[faces].reshape((-1, 3)) * scale + offset
+    origin = [s.start for s in job]
+    size = [len(a) for a in grid]
+    keys = _seam_keys(verts, shape, origin, size)
+    return (verts * scale + offset, faces, keys)
+
+def _dual_worker(sdf, grid, job, indexed):
+    # extend the batch by one cell on its lower sides so that the quads
+    # around the edges on those boundaries can be built
+    lower = [1 if s.start > 0 else 0 for s in job]
+    job = tuple(slice(s.start - d, s.stop) for s, d in zip(job, lower))
+    X, Y, Z = (a[s] for a, s in zip(grid, job))
+    # normals are sampled a little way off the grid edges
+    step = np.array([a[1] - a[0] for a in grid])
+    sdf = _prune(sdf, np.array((X[0], Y[0], Z[0])) - step,
+        np.array((X[-1], Y[-1], Z[-1])) + step)
+    shape = (len(X), len(Y), len(Z))
+    volume = _grid(sdf, X, Y, Z)
+    verts, faces, ijk = dc.dual_contouring(sdf, X, Y, Z, volume, lower)
+    if len(faces) == 0:
+        return []
+    if not indexed:
+        return verts[faces].reshape((-1, 3))
+    # vertices are identified by their cell, and only cells on the boundary
+    # of the batch can be shared with its neighbors
+    cells = np.array(shape) - 1
+    seam = np.any((ijk == 0) | (ijk == cells - 1), axis=1)
+    origin = [s.start for s in job]
+    size = [len(a) - 1 for a in grid]
+    index = np.ravel_multi_index((ijk + origin).T, size)
+    return (verts, faces, np.where(seam, index, -1))
+
+def _weld(results):
+    if not results:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=int)
+    vertices, faces, keys = zip(*results)
+    offsets = np.cumsum([0] + [len(v) for v in vertices[:-1]])
+    faces = np.concatenate([f + o for f, o in zip(faces, offsets)])
+    vertices = np.concatenate(vertices)
+    keys = np.concatenate(keys)
+    index = np.arange(len(vertices))
+    seam = np.flatnonzero(keys >= 0)
+    _, first, inverse = np.unique(
+        keys[seam], return_index=True, return_inverse=True)
+    index[seam] = seam[first][inverse]
+    keep = index == np.arange(len(vertices))
+    index = (np.cumsum(keep) - 1)[index]
+    return vertices[keep], index[faces]
+
+def _octree(sdf, X, Y, Z, s):
+    n = np.array([len(X), len(Y), len(Z)])
+    size = s
+    while np.any(size < n - 1):
+        size *= 2
+    cells = np.zeros((1, 3), dtype=int)
+    offsets = np.array(list(itertools.product((0, 1), repeat=3)))
+    while len(cells):
+        i0 = cells
+        i1 = np.minimum(cells + size, n - 1)
+        p0 = _vec(X[i0[:,0]], Y[i0[:,1]], Z[i0[:,2]])
+        p1 = _vec(X[i1[:,0]], Y[i1[:,1]], Z[i1[:,2]])
+        i = _interval(sdf, p0, p1)
+        if i is not None:
+            cells = cells[(i[0].reshape(-1) <= 0) & (i[1].reshape(-1) >= 0)]
+        else:
+            r = np.linalg.norm(p1 - p0, axis=1) / 2
+            d = np.abs(sdf((p0 + p1) / 2).reshape(-1))
+            cells = cells[d <= r]
+        if size == s:
+            break
+        size //= 2
+        cells = (cells[:,None,:] + offsets * size).reshape((-1, 3))
+        cells = cells[np.all(cells < n - 1, axis=1)]
+    return [(slice(i, i+s+1), slice(j, j+s+1), slice(k, k+s+1))
+        for i, j, k in cells]
+
+def _morton(batches):
+    # order the batches along a z-order curve, so that consecutive batches
+    # are near each other
+    if not batches:
+        return batches
+    ijk = np.array([[s.start for s in job] for job in batches])
+    code = np.zeros(len(batches), dtype=np.uint64)
+    for bit in range(21):
+        for axis in range(3):
+            b = (ijk[:,axis] >> bit) & 1
+            code |= b.astype(np.uint64) << np.uint64(3 * bit + axis)
+    return [batches[i] for i in np.argsort(code, kind='stable')]
+
+def _split(grid, job):
+    # halves of each axis with at least 2 * SPLIT_SIZE cells, sharing their
+    # middle sample
+    axes = []
+    for a, s in zip(grid, job):
+        stop = min(s.stop, len(a))
+        cells = stop - s.start - 1
+        if cells < 2 * SPLIT_SIZE:
+            axes.append([s])
+            continue
+        mid = s.start + cells // 2
+        axes.append([slice(s.start, mid + 1), slice(mid, stop)])
+    return list(itertools.product(*axes))
+
+def _schedule(submit, grid, batches, workers, skip=None):
+    # yields (weight, result) pairs as the batches finish, in any order. the
+    # weight is the part of an original batch that the result covers, and
+    # the result is None for split batches that skip() leaves out
+    pending = collections.deque((job, 1) for job in batches)
+    done = queue.Queue()
+    running = 0
+    while pending or running:
+        while pending and running < workers:
+            job, weight = pending.popleft()
+            if workers > 1 and len(pending) < workers:
+                jobs = _split(grid, job)
+                if len(jobs) > 1:
+                    w = weight / len(jobs)
+                    if skip is not None:
+                        mask = skip(jobs)
+                        for _ in range(np.count_nonzero(mask)):
+                            yield w, None
+                        jobs = [j for j, m in zip(jobs, mask) if not m]
+                    pending.extendleft((j, w) for j in reversed(jobs))
+                    continue
+            submit(job,
+                lambda r, w=weight: done.put((w, r, None)),
+                lambda e, w=weight: done.put((w, None, e)))
+            running += 1
+        weight, result, error = done.get()
+        running -= 1
+        if error is not None:
+            raise error
+        yield weight, result
+
+def _vec(*arrs):
+    return np.stack(arrs, axis=-1)
+
+_process_args = None
+
+def _process_init(*args):
+    global _process_args
+    _process_args = args
+
+_Shared = collections.namedtuple('_Shared', ['name', 'shape', 'dtype'])
+
+def _share(a):
+    a = np.ascontiguousarray(a)
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    # the parent process takes ownership of the block and unlinks it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    b = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    b[:] = a
+    del b
+    shm.close()
+    return _Shared(shm.name, a.shape, a.dtype.str)
+
+def _unshare(shared):
+    shm = shared_memory.SharedMemory(name=shared.name)
+    try:
+        buf = shm.buf
+        a = np.ndarray(shared.shape, dtype=shared.dtype, buffer=buf).copy()
+        del buf
+    finally:
+        shm.close()
+        shm.unlink()
+    return a
+
+def _process_worker(job):
+    result = _worker(*_process_args[:2], job, *_process_args[2:])
+    if result is None or len(result) == 0:
+        return result
+    if isinstance(result, tuple):
+        return tuple(_share(a) for a in result)
+    return _share(result)
+
+def _process_result(result):
+    if isinstance(result, _Shared):
+        return _unshare(result)
+    if isinstance(result, tuple):
+        return tuple(_unshare(a) for a in result)
+    return result
+
+def _process_release(result):
+    # unlink the blocks of a result that is never read
+    if isinstance(result, _Shared):
+        result = (result,)
+    for a in result or ():
+        if isinstance(a, _Shared):
+            shm = shared_memory.SharedMemory(name=a.name)
+            shm.close()
+            shm.unlink()
+
+def _process_pool(sdf, workers, grid, indexed, method):
+    args = (sdf, grid, indexed, method)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        try:
+            pickle.dumps(args)
+        except Exception as e:
+            raise ValueError(
+                'the SDF cannot be sent to worker processes (%s); '
+                'use backend=\'thread\' instead' % e)
+        context = multiprocessing.get_context()
+    return context.Pool(workers, _process_init, args)
+
+def _bounds(sdf):
+    bounds = getattr(sdf, 'bounds', None)
+    if bounds is None or not np.all(np.isfinite(bounds)):
+        return None
+    return bounds
 
 def _estimate_bounds(sdf):
     # TODO: raise exception if bound estimation fails
@@ -74,23 +334,28 @@ def _estimate_bounds(sdf):
         if threshold == prev:
             break
         prev = threshold
-        P = _cartesian_product(X, Y, Z)
-        volume = sdf(P).reshape((len(X), len(Y), len(Z)))
+        volume = _grid(sdf, X, Y, Z)
         where = np.argwhere(np.abs(volume) <= threshold)
         x1, y1, z1 = (x0, y0, z0) + where.max(axis=0) * d + d / 2
         x0, y0, z0 = (x0, y0, z0) + where.min(axis=0) * d - d / 2
     return ((x0, y0, z0), (x1, y1, z1))
 
-def generate(
+def _generate(
         sdf,
         step=None, bounds=None, samples=SAMPLES,
         workers=WORKERS, batch_size=BATCH_SIZE,
-        verbose=True, sparse=True):
+        verbose=True, sparse=True, mode='grid', backend='thread',
+        method='marching_cubes', indexed=False):
 
     start = time.time()
 
+    padding = 0
+    if bounds is None:
+        bounds = _bounds(sdf)
+        padding = 2
     if bounds is None:
         bounds = _estimate_bounds(sdf)
+        padding = 0
     (x0, y0, z0), (x1, y1, z1) = bounds
 
     if step is None and samples is not None:
@@ -102,6 +367,11 @@ def generate(
     except TypeError:
         dx = dy = dz = step
 
+    # analytic bounds are tight, so pad them to make sure that the outermost
+    # samples are outside of the surface
+    x0, y0, z0 = np.array((x0, y0, z0)) - np.array((dx, dy, dz)) * padding
+    x1, y1, z1 = np.array((x1, y1, z1)) + np.array((dx, dy, dz)) * padding
+
     if verbose:
         print('min %g, %g, %g' % (x0, y0, z0))
         print('max %g, %g, %g' % (x1, y1, z1))
@@ -111,57 +381,130 @@ def generate(
     Y = np.arange(y0, y1, dy)
     Z = np.arange(z0, z1, dz)
 
+    if method not in ('marching_cubes', 'dual_contouring'):
+        raise ValueError('unknown method: %r' % method)
+
     s = batch_size
-    Xs = [X[i:i+s+1] for i in range(0, len(X), s)]
-    Ys = [Y[i:i+s+1] for i in range(0, len(Y), s)]
-    Zs = [Z[i:i+s+1] for i in range(0, len(Z), s)]
+    grid = (X, Y, Z)
+    if mode == 'grid':
+        Xs = [slice(i, i+s+1) for i in range(0, len(X), s)]
+        Ys = [slice(i, i+s+1) for i in range(0, len(Y), s)]
+        Zs = [slice(i, i+s+1) for i in range(0, len(Z), s)]
+        batches = list(itertools.product(Xs, Ys, Zs))
+    elif mode == 'octree':
+        batches = _octree(sdf, X, Y, Z, s)
+    else:
+        raise ValueError('unknown mode: %r' % mode)
 
-    batches = list(itertools.product(Xs, Ys, Zs))
+    batches = _morton(batches)
     num_batches = len(batches)
-    num_samples = sum(len(xs) * len(ys) * len(zs)
+    num_samples = sum(len(X[xs]) * len(Y[ys]) * len(Z[zs])
         for xs, ys, zs in batches)
 
     if verbose:
         print('%d samples in %d batches with %d workers' %
             (num_samples, num_batches, workers))
 
-    points = []
+    triangles = 0
     skipped = empty = nonempty = 0
-    bar = progress.Bar(num_batches, enabled=verbose)
-    pool = ThreadPool(workers)
-    f = partial(_worker, sdf, step=(dx, dy, dz), sparse=sparse)
-    for result in pool.imap(f, batches):
-        bar.increment(1)
-        if result is None:
-            skipped += 1
-        elif len(result) == 0:
-            empty += 1
-        else:
-            nonempty += 1
-            points.extend(result)
-    bar.done()
+    skip = None
+    if sparse:
+        skip = partial(_skip, sdf, grid)
+        mask = skip(batches)
+        skipped = np.count_nonzero(mask)
+        batches = [job for job, m in zip(batches, mask) if not m]
+    bar = progress.Bar(len(batches), enabled=verbose)
+    if backend == 'thread':
+        pool = ThreadPool(workers)
+        f = partial(_worker, sdf, grid, indexed=indexed, method=method)
+    elif backend == 'process':
+        pool = _process_pool(sdf, workers, grid, indexed, method)
+        f = _process_worker
+    else:
+        raise ValueError('unknown backend: %r' % backend)
+    # results that finished but haven't been read yet, by id
+    unread = {}
+    def submit(job, callback, error_callback):
+        def f_callback(result):
+            unread[id(result)] = result
+            callback(result)
+        pool.apply_async(f, (job,),
+            callback=f_callback, error_callback=error_callback)
+    try:
+        for weight, result in _schedule(submit, grid, batches, workers, skip):
+            unread.pop(id(result), None)
+            if backend == 'process':
+                result = _process_result(result)
+            bar.increment(weight)
+            if result is None:
+                skipped += 1
+            elif len(result) == 0:
+                empty += 1
+            else:
+                nonempty += 1
+                triangles += len(result[1]) if indexed else len(result) // 3
+                yield result
+        bar.done()
+    finally:
+        pool.close()
+        if backend == 'process':
+            # the blocks of results that were never read are only freed here
+            pool.join()
+            for result in unread.values():
+                _process_release(result)
 
     if verbose:
         print('%d skipped, %d empty, %d nonempty' % (skipped, empty, nonempty))
-        triangles = len(points) // 3
         seconds = time.time() - start
         print('%d triangles in %g seconds' % (triangles, seconds))
 
-    return points
+def generate_iter(*args, **kwargs):
+    return _generate(*args, indexed=False, **kwargs)
+
+def generate(sdf, *args, indexed=False, simplify=None, **kwargs):
+    if simplify is None:
+        results = list(_generate(sdf, *args, indexed=indexed, **kwargs))
+        if indexed:
+            return _weld(results)
+        if not results:
+            return np.zeros((0, 3))
+        return np.concatenate(results)
+
+    # an int is a target triangle count, a float is a maximum error
+    if isinstance(simplify, (bool, np.bool_)):
+        raise ValueError('simplify must be a triangle count or an error')
+    results = list(_generate(sdf, *args, indexed=True, **kwargs))
+    vertices, faces = _weld(results)
+    start = time.time()
+    if isinstance(simplify, numbers.Integral):
+        vertices, faces = decimate.decimate(
+            vertices, faces, count=simplify, sdf=sdf)
+    else:
+        vertices, faces = decimate.decimate(
+            vertices, faces, error=simplify, sdf=sdf)
+    if kwargs.get('verbose', True):
+        seconds = time.time() - start
+        print('simplified to %d triangles in %g seconds' %
+            (len(faces), seconds))
+    if indexed:
+        return vertices, faces
+    return vertices[faces].reshape((-1, 3))
 
 def save(path, *args, **kwargs):
-    points = generate(*args, **kwargs)
-    if path.lower().endswith('.stl'):
-        stl.write_binary_stl(path, points)
+    if path.lower().endswith('.stl') and kwargs.get('simplify') is not None:
+        stl.write_binary_stl(path, generate(*args, **kwargs))
+    elif path.lower().endswith('.stl'):
+        with stl.BinarySTLWriter(path) as writer:
+            for points in generate_iter(*args, **kwargs):
+                writer.write(points)
     else:
-        mesh = _mesh(points)
+        vertices, faces = generate(*args, indexed=True, **kwargs)
+        mesh = _mesh(vertices, faces)
         mesh.write(path)
 
-def _mesh(points):
+def _mesh(vertices, faces):
     import meshio
-    points, cells = np.unique(points, axis=0, return_inverse=True)
-    cells = [('triangle', cells.reshape((-1, 3)))]
-    return meshio.Mesh(points, cells)
+    return meshio.Mesh(vertices, [('triangle', faces)])
 
 def _debug_triangles(X, Y, Z):
     x0, x1 = X[0], X[-1]
@@ -203,6 +546,8 @@ def sample_slice(
         sdf, w=1024, h=1024,
         x=None, y=None, z=None, bounds=None):
 
+    if bounds is None:
+        bounds = _bounds(sdf)
     if bounds is None:
         bounds = _estimate_bounds(sdf)
     (x0, y0, z0), (x1, y1, z1) = bounds
@@ -228,8 +573,7 @@ def sample_slice(
     else:
         raise Exception('x, y, or z position must be specified')
 
-    P = _cartesian_product(X, Y, Z)
-    return sdf(P).reshape((w, h)), extent, axes
+    return _grid(sdf, X, Y, Z).reshape((w, h)), extent, axes
 
 def show_slice(*args, **kwargs):
     import matplotlib.pyplot as plt
@@ -2,7 +2,7 @@ import functools
 import numpy as np
 import operator
 
-from . import dn, d3, ease
+from . import dn, d3, ease, graph, jit
 
 # Constants
 
@@ -13,13 +13,22 @@ Y = np.array((0, 1))
 
 UP = Y
 
+# polygons with at least POLYGON_EDGES edges that are evaluated at more than
+# POLYGON_POINTS points only check the edges near each point. POLYGON_PAIRS
+# limits the (point, edge) pairs that are checked at once
+POLYGON_EDGES = 64
+POLYGON_POINTS = 16
+POLYGON_LEVELS = 12
+POLYGON_PAIRS = 2 ** 20
+
 # SDF Class
 
 _ops = {}
 
 class SDF2:
-    def __init__(self, f):
+    def __init__(self, f, node=None):
         self.f = f
+        self.node = node
     def __call__(self, p):
         return self.f(p).reshape((-1, 1))
     def __getattr__(self, name):
@@ -36,34 +45,73 @@ class SDF2:
     def k(self, k=None):
         self._k = k
         return self
+    @property
+    def bounds(self):
+        return dn._bounds(self.f)
+    def interval(self, lo, hi):
+        lo = np.atleast_2d(np.array(lo, dtype=float))
+        hi = np.atleast_2d(np.array(hi, dtype=float))
+        i = dn._interval(self.f, lo, hi)
+        if i is None:
+            return None
+        return tuple(x.reshape((-1, 1)) for x in i)
+    def grid(self, X, Y):
+        d = dn._grid(self, np.ix_(X, Y))
+        return np.broadcast_to(d, (len(X), len(Y)))
+    def prune(self, lo, hi):
+        prune = getattr(self.f, 'prune', None)
+        if prune is None:
+            return self
+        lo = np.atleast_2d(np.array(lo, dtype=float))
+        hi = np.atleast_2d(np.array(hi, dtype=float))
+        result = prune(lo, hi)
+        if result is None:
+            return self
+        # unions and friends read the smoothing factor of their children
+        k = getattr(self, '_k', None)
+        if getattr(result, '_k', None) != k:
+            result = type(result)(result.f, result.node)
+            result._k = k
+        return result
+    def optimize(self):
+        return graph.optimize(self)
+    def compile(self):
+        return jit.compile(self)
 
 def sdf2(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return SDF2(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return SDF2(f(*args, **kwargs), node)
     return wrapper
 
 def op2(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return SDF2(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return SDF2(f(*args, **kwargs), node)
     _ops[f.__name__] = wrapper
     return wrapper
 
 def op23(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return d3.SDF3(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return d3.SDF3(f(*args, **kwargs), node)
     _ops[f.__name__] = wrapper
     return wrapper
 
 # Helpers
 
 def _length(a):
-    return np.linalg.norm(a, axis=1)
+    # einsum doesn't allocate the squares of every component
+    return np.sqrt(np.einsum('ij,ij->i', a, a))
 
 def _normalize(a):
     return a / np.linalg.norm(a)
 
 def _dot(a, b):
-    return np.sum(a * b, axis=1)
+    return np.einsum('...i,...i->...', a, b)
 
 def _vec(*arrs):
     return np.stack(arrs, axis=-1)
@@ -77,6 +125,13 @@ _max = np.maximum
 def circle(radius=1, center=ORIGIN):
     def f(p):
         return _length(p - center) - radius
+    def grid(x, y):
+        cx, cy = np.array(center) * np.ones(2)
+        return np.sqrt((x - cx) ** 2 + (y - cy) ** 2) - radius
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = (np.array(center) - radius, np.array(center) + radius)
+    f.exact = True
     return f
 
 @sdf2
@@ -84,6 +139,9 @@ def line(normal=UP, point=ORIGIN):
     normal = _normalize(normal)
     def f(p):
         return np.dot(point - p, normal)
+    f.interval = dn._lipschitz(f)
+    f.bounds = dn._halfspace_bounds(normal, point)
+    f.exact = True
     return f
 
 @sdf2
@@ -111,6 +169,16 @@ def rectangle(size=1, center=ORIGIN, a=None, b=None):
     def f(p):
         q = np.abs(p - center) - size / 2
         return _length(_max(q, 0)) + _min(np.amax(q, axis=1), 0)
+    def grid(*axes):
+        c = np.array(center) * np.ones(2)
+        s = size * np.ones(2)
+        q = [np.abs(a - c[i]) - s[i] / 2 for i, a in enumerate(axes)]
+        outside = np.sqrt(sum(_max(x, 0) ** 2 for x in q))
+        return outside + _min(_max(q[0], q[1]), 0)
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = (np.array(center) - size / 2, np.array(center) + size / 2)
+    f.exact = True
     return f
 
 @sdf2
@@ -131,6 +199,9 @@ def rounded_rectangle(size, radius, center=ORIGIN):
         return (
             _min(_max(q[:,0], q[:,1]), 0).reshape((-1, 1)) +
             _length(_max(q, 0)).reshape((-1, 1)) - r)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.array(size) / 2, np.array(size) / 2)
+    f.exact = True
     return f
 
 @sdf2
@@ -149,10 +220,15 @@ def equilateral_triangle():
             p[:,0] - np.clip(p[:,0], -2, 0),
             p[:,1])
         return -_length(p) * np.sign(p[:,1])
+    k = 3 ** 0.5
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.array((-1, -1 / k)), np.array((1, 2 / k)))
+    f.exact = True
     return f
 
 @sdf2
 def hexagon(r):
+    bounds = (-np.full(2, r), np.full(2, r))
     r *= 3 ** 0.5 / 2
     def f(p):
         k = np.array((3 ** 0.5 / -2, 0.5, np.tan(np.pi / 6)))
@@ -162,6 +238,9 @@ def hexagon(r):
             np.clip(p[:,0], -k[2] * r, k[2] * r),
             np.zeros(len(p)) + r)
         return _length(p) * np.sign(p[:,1])
+    f.interval = dn._lipschitz(f)
+    f.bounds = bounds
+    f.exact = True
     return f
 
 @sdf2
@@ -170,29 +249,150 @@ def rounded_x(w, r):
         p = np.abs(p)
         q = (_min(p[:,0] + p[:,1], w) * 0.5).reshape((-1, 1))
         return _length(p - q) - r
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.full(2, w / 2 + r), np.full(2, w / 2 + r))
+    f.exact = True
     return f
 
+def _segment_distance(p, a, b):
+    # squared distance from points p to segments a-b, broadcast together
+    ex, ey = b[...,0] - a[...,0], b[...,1] - a[...,1]
+    wx, wy = p[...,0] - a[...,0], p[...,1] - a[...,1]
+    ee = ex * ex + ey * ey
+    h = np.clip((wx * ex + wy * ey) / np.where(ee > 0, ee, 1), 0, 1)
+    dx, dy = wx - ex * h, wy - ey * h
+    return dx * dx + dy * dy
+
+def _segment_flips(p, a, b):
+    # whether edges a-b flip the sign of points p, broadcast together
+    c1 = p[...,1] >= a[...,1]
+    c2 = p[...,1] < b[...,1]
+    c3 = (b[...,0] - a[...,0]) * (p[...,1] - a[...,1]) > \
+        (b[...,1] - a[...,1]) * (p[...,0] - a[...,0])
+    return (c1 & c2 & c3) | ~(c1 | c2 | c3)
+
+def _polygon_groups(p, key, keep, n):
+    # (point, edge) pairs, grouped by point, for the edges that keep(lo, hi)
+    # selects for the box around each group of points with the same key
+    idx = np.argsort(key, kind='stable')
+    starts = np.flatnonzero(np.diff(key[idx], prepend=-1))
+    q = p[idx]
+    lo = np.minimum.reduceat(q, starts)
+    hi = np.maximum.reduceat(q, starts)
+    size = max(POLYGON_PAIRS // n, 1)
+    gs, js = [], []
+    for k in range(0, len(starts), size):
+        g, j = np.nonzero(keep(lo[k:k+size], hi[k:k+size]))
+        gs.append(g + k)
+        js.append(j)
+    g, j = np.concatenate(gs), np.concatenate(js)
+    counts = np.bincount(g, minlength=len(starts))
+    group = np.repeat(np.arange(len(starts)),
+        np.diff(np.append(starts, len(idx))))
+    c = counts[group]
+    first = np.cumsum(counts) - counts
+    return np.repeat(idx, c), j[dn._ranges(first[group], c)], c
+
+def _polygon_near(p, a, b):
+    # squared distance to the nearest edge. the points are split into
+    # quadrants, and each box only keeps the edges that can be closer than
+    # the farthest point of the box is from the start of some edge
+    n = len(p)
+    elo, ehi = _min(a, b), _max(a, b)
+    result = np.empty(n)
+    idx = np.arange(n)
+    starts = np.zeros(1, dtype=int)
+    # (box, edge) pairs that are still alive
+    pc = np.zeros(len(a), dtype=int)
+    pj = np.arange(len(a))
+    for level in range(POLYGON_LEVELS):
+        q = p[idx]
+        lo = np.minimum.reduceat(q, starts)
+        hi = np.maximum.reduceat(q, starts)
+        counts = np.diff(np.append(starts, len(idx)))
+        l, h, v = lo[pc], hi[pc], a[pj]
+        far = _max(np.abs(v - l), np.abs(v - h))
+        t = np.full(len(starts), np.inf)
+        np.minimum.at(t, pc, far[:,0] * far[:,0] + far[:,1] * far[:,1])
+        gap = _max(_max(elo[pj] - h, l - ehi[pj]), 0)
+        alive = gap[:,0] * gap[:,0] + gap[:,1] * gap[:,1] <= t[pc]
+        pc, pj = pc[alive], pj[alive]
+
+        # boxes with many points and edges left are split, the rest check
+        # the edges that they kept
+        edges = np.bincount(pc, minlength=len(starts))
+        split = (counts > POLYGON_POINTS) & (edges > 4)
+        if level == POLYGON_LEVELS - 1:
+            split[:] = False
+        cell = np.repeat(np.arange(len(starts)), counts)
+        s = split[cell]
+        w = split[pc]
+        e = np.where(split, 0, edges)
+        first = np.cumsum(e) - e
+        c = e[cell[~s]]
+        i = np.repeat(idx[~s], c)
+        j = pj[~w][np.argsort(pc[~w])][dn._ranges(first[cell[~s]], c)]
+        d = _segment_distance(p[i], a[j], b[j])
+        k = np.cumsum(c) - c
+        result[idx[~s]] = np.minimum.reduceat(d, k) if len(k) else d[:0]
+        if not np.any(split):
+            break
+
+        idx, cell = idx[s], cell[s]
+        center = (lo + hi) / 2
+        code = np.sum((p[idx] > center[cell]) << np.arange(2), axis=1)
+        key = cell * 4 + code
+        order = np.argsort(key, kind='stable')
+        idx, key = idx[order], key[order]
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        # every pair of a split box moves to the boxes that it was split into
+        parent = key[starts] >> 2
+        first = np.searchsorted(parent, np.arange(len(split) + 1))
+        pc, pj = pc[w], pj[w]
+        size = first[pc + 1] - first[pc]
+        pj = np.repeat(pj, size)
+        pc = dn._ranges(first[pc], size)
+    return result
+
+def _polygon_index(p, a, b):
+    n = len(p)
+    lo, hi = p.min(axis=0), p.max(axis=0)
+    elo, ehi = _min(a, b), _max(a, b)
+    d = _polygon_near(p, a, b)
+
+    # sign: points are grouped into horizontal bands, and each band only
+    # checks the edges that span part of it
+    def span(lo, hi):
+        return (elo[:,1] <= hi[:,1:]) & (ehi[:,1] >= lo[:,1:])
+    m = max(n // POLYGON_POINTS, 1)
+    size = hi[1] - lo[1] if hi[1] > lo[1] else 1
+    i = np.clip(((p[:,1] - lo[1]) / size * m).astype(int), 0, m - 1)
+    i, j, _ = _polygon_groups(p, i, span, len(a))
+    c = _segment_flips(p[i], a[j], b[j])
+    flips = np.bincount(i, weights=c, minlength=n)
+    return np.where(flips % 2, -1, 1) * np.sqrt(d)
+
 @sdf2
 def polygon(points):
-    points = [np.array(p) for p in points]
+    points = np.asarray(points, dtype=float).reshape((-1, 2))
+    a = points
+    b = np.roll(points, 1, axis=0)
     def f(p):
-        n = len(points)
-        d = _dot(p - points[0], p - points[0])
-        s = np.ones(len(p))
-        for i in range(n):
-            j = (i + n - 1) % n
-            vi = points[i]
-            vj = points[j]
-            e = vj - vi
-            w = p - vi
-            b = w - e * np.clip(np.dot(w, e) / np.dot(e, e), 0, 1).reshape((-1, 1))
-            d = _min(d, _dot(b, b))
-            c1 = p[:,1] >= vi[1]
-            c2 = p[:,1] < vj[1]
-            c3 = e[0] * w[:,1] > e[1] * w[:,0]
-            c = _vec(c1, c2, c3)
-            s = np.where(np.all(c, axis=1) | np.all(~c, axis=1), -s, s)
-        return s * np.sqrt(d)
+        if len(a) >= POLYGON_EDGES and len(p) > POLYGON_POINTS:
+            # large polygons only check the edges near each point
+            return _polygon_index(p, a, b)
+        # small polygons check every edge, a chunk of points at a time
+        size = max(POLYGON_PAIRS // len(a), 1)
+        result = []
+        for k in range(0, len(p), size):
+            q = p[k:k+size,None]
+            d = np.min(_segment_distance(q, a, b), axis=1)
+            c = np.sum(_segment_flips(q, a, b), axis=1)
+            result.append(np.where(c % 2, -1, 1) * np.sqrt(d))
+        return np.concatenate(result or [np.empty(0)])
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.min(points, axis=0), np.max(points, axis=0))
+    f.exact = True
     return f
 
 @sdf2
@@ -204,6 +404,10 @@ def vesica(r, d):
             ((p[:,1] - b) * d > p[:,0] * b),
             _length(p - np.array([0, b])),
             _length(p - np.array([-d, 0])) - r)
+    b = np.sqrt(r * r - d * d)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.array((d - r, -b)), np.array((r - d, b)))
+    f.exact = True
     return f
 
 # Positioning
@@ -212,6 +416,12 @@ def vesica(r, d):
 def translate(other, offset):
     def f(p):
         return other(p - offset)
+    f.bounds = dn._transform_bounds(other.bounds, np.eye(2), offset)
+    f.affine = (np.eye(2), np.zeros(2) - offset, 1)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op2
@@ -224,6 +434,12 @@ def scale(other, factor):
     m = min(x, y)
     def f(p):
         return other(p / s) * m
+    f.bounds = dn._transform_bounds(other.bounds, np.diag(s))
+    f.affine = (np.diag(1 / np.array(s)), np.zeros(2), m)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op2
@@ -237,12 +453,39 @@ def rotate(other, angle):
     ]).T
     def f(p):
         return other(np.dot(p, matrix))
+    f.bounds = dn._transform_bounds(other.bounds, matrix.T)
+    f.affine = (matrix, np.zeros(2), 1)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op2
-def circular_array(other, count):
-    angles = [i / count * 2 * np.pi for i in range(count)]
-    return union(*[other.rotate(a) for a in angles])
+def circular_array(other, count, padding=0):
+    # the angle of each point is folded into the first sector, so only the
+    # copies on either side of it are evaluated. padding adds more copies on
+    # each side for shapes that reach across several sectors
+    da = 2 * np.pi / count
+    js = list(range(-padding, padding + 2))[:count]
+    def f(p):
+        x = p[:,0]
+        y = p[:,1]
+        d = np.hypot(x, y)
+        a = np.arctan2(y, x) % da
+        ds = [other(_vec(np.cos(a - j * da) * d, np.sin(a - j * da) * d))
+            for j in js]
+        result = ds[0]
+        for e in ds[1:]:
+            result = _min(result, e)
+        return result
+    def interval(lo, hi):
+        # the points lie within padding + 1 sectors on either side
+        (x0, y0), (x1, y1) = dn._wedge_bounds(lo, hi, da * (padding + 1))
+        return dn._interval(other, _vec(x0, y0), _vec(x1, y1))
+    f.interval = interval
+    f.bounds = dn._radial_bounds(other.bounds)
+    return f
 
 # Alterations
 
@@ -254,16 +497,51 @@ def elongate(other, size):
         y = q[:,1].reshape((-1, 1))
         w = _min(_max(x, y), 0)
         return other(_max(q, 0)) + w
+    f.interval = dn._elongate_interval(other, size)
+    f.bounds = None
+    if other.bounds is not None:
+        r = np.max(np.abs(other.bounds), axis=0) + size
+        f.bounds = (-r, r)
     return f
 
 # 2D => 3D Operations
 
+def _extrude_interval(d, lo, hi, h):
+    # the result grows with both d and |z|
+    if d is None:
+        return None
+    z0, z1 = dn._abs_interval(lo[:,2], hi[:,2])
+    def g(d, z):
+        w = _vec(d, z - h / 2)
+        return _min(_max(w[:,0], w[:,1]), 0) + _length(_max(w, 0))
+    return (g(d[0], z0), g(d[1], z1))
+
+def _extrude_bounds(bounds, h):
+    if bounds is None:
+        return None
+    lo, hi = bounds
+    return (np.append(lo, -h / 2), np.append(hi, h / 2))
+
+def _extrude_grid(d, z, h):
+    w = np.abs(z) - h / 2
+    return _min(_max(d, w), 0) + np.sqrt(_max(d, 0) ** 2 + _max(w, 0) ** 2)
+
 @op23
 def extrude(other, h):
     def f(p):
         d = other(p[:,[0,1]])
         w = _vec(d.reshape(-1), np.abs(p[:,2]) - h / 2)
         return _min(_max(w[:,0], w[:,1]), 0) + _length(_max(w, 0))
+    def interval(lo, hi):
+        d = dn._interval(other, lo[:,:2], hi[:,:2])
+        return _extrude_interval(d, lo, hi, h)
+    def grid(x, y, z):
+        # the profile is evaluated once per column
+        return _extrude_grid(dn._grid(other, (x, y)), z, h)
+    f.interval = interval
+    f.grid = grid
+    f.bounds = _extrude_bounds(other.bounds, h)
+    f.exact = dn._exact(other)
     return f
 
 @op23
@@ -275,6 +553,21 @@ def extrude_to(a, b, h, e=ease.linear):
         d = d1 + (d2 - d1) * t.reshape((-1, 1))
         w = _vec(d.reshape(-1), np.abs(p[:,2]) - h / 2)
         return _min(_max(w[:,0], w[:,1]), 0) + _length(_max(w, 0))
+    t = dn._ease_range(e)
+    def interval(lo, hi):
+        d1 = dn._interval(a, lo[:,:2], hi[:,:2])
+        d2 = dn._interval(b, lo[:,:2], hi[:,:2])
+        if d1 is None or d2 is None:
+            return None
+        return _extrude_interval(dn._mix_interval(d1, d2, t), lo, hi, h)
+    def grid(x, y, z):
+        d1 = dn._grid(a, (x, y))
+        d2 = dn._grid(b, (x, y))
+        t = e(np.clip(z / h, -0.5, 0.5) + 0.5)
+        return _extrude_grid(d1 + (d2 - d1) * t, z, h)
+    f.interval = interval
+    f.grid = grid
+    f.bounds = _extrude_bounds(dn._union_bounds(a.bounds, b.bounds), h)
     return f
 
 @op23
@@ -283,6 +576,28 @@ def revolve(other, offset=0):
         xy = p[:,[0,1]]
         q = _vec(_length(xy) - offset, p[:,2])
         return other(q)
+    def interval(lo, hi):
+        r0, r1 = dn._norm_interval(lo[:,:2], hi[:,:2])
+        return dn._interval(other,
+            _vec(r0 - offset, lo[:,2]), _vec(r1 - offset, hi[:,2]))
+    def grid(x, y, z):
+        # the profile is evaluated once per distinct radius and height
+        r = np.sqrt(x * x + y * y) - offset
+        if r.size * z.size > np.prod(np.broadcast_shapes(r.shape, z.shape)):
+            return None
+        u, inverse = np.unique(r, return_inverse=True)
+        table = np.broadcast_to(
+            dn._grid(other, (u.reshape((-1, 1)), z.reshape((1, -1)))),
+            (len(u), z.size))
+        i = inverse.reshape(-1)[np.arange(r.size).reshape(r.shape)]
+        return table[i, np.arange(z.size).reshape(z.shape)]
+    f.interval = interval
+    f.grid = grid
+    f.bounds = None
+    if other.bounds is not None:
+        (_, y0), (x1, y1) = other.bounds
+        r = max(x1 + offset, 0)
+        f.bounds = (np.array((-r, -r, y0)), np.array((r, r, y1)))
     return f
 
 # Common
@@ -2,7 +2,7 @@ import functools
 import numpy as np
 # import operator
 
-from . import core, dn, d2, ease
+from . import core, dn, d2, ease, graph, jit
 
 # Constants
 
@@ -19,8 +19,9 @@ UP = Z
 _ops = {}
 
 class SDF3:
-    def __init__(self, f):
+    def __init__(self, f, node=None):
         self.f = f
+        self.node = node
     def __call__(self, p):
         return self.f(p).reshape((-1, 1))
     def __getattr__(self, name):
@@ -38,40 +39,81 @@ class SDF3:
     def k(self, k=None):
         self._k = k
         return self
+    @property
+    def bounds(self):
+        return dn._bounds(self.f)
+    def interval(self, lo, hi):
+        lo = np.atleast_2d(np.array(lo, dtype=float))
+        hi = np.atleast_2d(np.array(hi, dtype=float))
+        i = dn._interval(self.f, lo, hi)
+        if i is None:
+            return None
+        return tuple(x.reshape((-1, 1)) for x in i)
+    def grid(self, X, Y, Z):
+        d = dn._grid(self, np.ix_(X, Y, Z))
+        return np.broadcast_to(d, (len(X), len(Y), len(Z)))
+    def prune(self, lo, hi):
+        prune = getattr(self.f, 'prune', None)
+        if prune is None:
+            return self
+        lo = np.atleast_2d(np.array(lo, dtype=float))
+        hi = np.atleast_2d(np.array(hi, dtype=float))
+        result = prune(lo, hi)
+        if result is None:
+            return self
+        # unions and friends read the smoothing factor of their children
+        k = getattr(self, '_k', None)
+        if getattr(result, '_k', None) != k:
+            result = type(result)(result.f, result.node)
+            result._k = k
+        return result
+    def optimize(self):
+        return graph.optimize(self)
+    def compile(self):
+        return jit.compile(self)
     def generate(self, *args, **kwargs):
         return core.generate(self, *args, **kwargs)
+    def generate_iter(self, *args, **kwargs):
+        return core.generate_iter(self, *args, **kwargs)
     def save(self, path, *args, **kwargs):
         return core.save(path, self, *args, **kwargs)
     def show_slice(self, *args, **kwargs):
         return core.show_slice(self, *args, **kwargs)
 
 def sdf3(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return SDF3(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return SDF3(f(*args, **kwargs), node)
     return wrapper
 
 def op3(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return SDF3(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return SDF3(f(*args, **kwargs), node)
     _ops[f.__name__] = wrapper
     return wrapper
 
 def op32(f):
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        return d2.SDF2(f(*args, **kwargs))
+        node = graph.Node(f.__name__, wrapper, args, kwargs)
+        return d2.SDF2(f(*args, **kwargs), node)
     _ops[f.__name__] = wrapper
     return wrapper
 
 # Helpers
 
 def _length(a):
-    return np.linalg.norm(a, axis=1)
+    # einsum doesn't allocate the squares of every component
+    return np.sqrt(np.einsum('ij,ij->i', a, a))
 
 def _normalize(a):
     return a / np.linalg.norm(a)
 
 def _dot(a, b):
-    return np.sum(a * b, axis=1)
+    return np.einsum('...i,...i->...', a, b)
 
 def _vec(*arrs):
     return np.stack(arrs, axis=-1)
@@ -93,6 +135,13 @@ _max = np.maximum
 def sphere(radius=1, center=ORIGIN):
     def f(p):
         return _length(p - center) - radius
+    def grid(x, y, z):
+        cx, cy, cz = np.array(center) * np.ones(3)
+        return np.sqrt((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2) - radius
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = (np.array(center) - radius, np.array(center) + radius)
+    f.exact = True
     return f
 
 @sdf3
@@ -100,6 +149,14 @@ def plane(normal=UP, point=ORIGIN):
     normal = _normalize(normal)
     def f(p):
         return np.dot(point - p, normal)
+    def grid(*axes):
+        q = np.array(point) * np.ones(3)
+        return sum((q[i] - a) * normal[i] for i, a in enumerate(axes)
+            if normal[i] != 0)
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = dn._halfspace_bounds(normal, point)
+    f.exact = True
     return f
 
 @sdf3
@@ -131,6 +188,16 @@ def box(size=1, center=ORIGIN, a=None, b=None):
     def f(p):
         q = np.abs(p - center) - size / 2
         return _length(_max(q, 0)) + _min(np.amax(q, axis=1), 0)
+    def grid(*axes):
+        c = np.array(center) * np.ones(3)
+        s = size * np.ones(3)
+        q = [np.abs(a - c[i]) - s[i] / 2 for i, a in enumerate(axes)]
+        outside = np.sqrt(sum(_max(x, 0) ** 2 for x in q))
+        return outside + _min(_max(_max(q[0], q[1]), q[2]), 0)
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = (np.array(center) - size / 2, np.array(center) + size / 2)
+    f.exact = True
     return f
 
 @sdf3
@@ -139,6 +206,9 @@ def rounded_box(size, radius):
     def f(p):
         q = np.abs(p) - size / 2 + radius
         return _length(_max(q, 0)) + _min(np.amax(q, axis=1), 0) - radius
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-size / 2, size / 2)
+    f.exact = True
     return f
 
 @sdf3
@@ -152,6 +222,9 @@ def wireframe_box(size, thickness):
         px, py, pz = p[:,0], p[:,1], p[:,2]
         qx, qy, qz = q[:,0], q[:,1], q[:,2]
         return _min(_min(g(px, qy, qz), g(qx, py, qz)), g(qx, qy, pz))
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-size / 2 - thickness, size / 2 + thickness)
+    f.exact = True
     return f
 
 @sdf3
@@ -162,6 +235,10 @@ def torus(r1, r2):
         a = _length(xy) - r1
         b = _length(_vec(a, z)) - r2
         return b
+    r = r1 + r2
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.array((-r, -r, -r2)), np.array((r, r, r2)))
+    f.exact = True
     return f
 
 @sdf3
@@ -173,12 +250,23 @@ def capsule(a, b, radius):
         ba = b - a
         h = np.clip(np.dot(pa, ba) / np.dot(ba, ba), 0, 1).reshape((-1, 1))
         return _length(pa - np.multiply(ba, h)) - radius
+    f.interval = dn._lipschitz(f)
+    f.bounds = (_min(a, b) - radius, _max(a, b) + radius)
+    f.exact = True
     return f
 
 @sdf3
 def cylinder(radius):
     def f(p):
         return _length(p[:,[0,1]]) - radius;
+    def grid(x, y, z):
+        return np.sqrt(x * x + y * y) - radius
+    f.interval = dn._lipschitz(f)
+    f.grid = grid
+    f.bounds = (
+        np.array((-radius, -radius, -np.inf)),
+        np.array((radius, radius, np.inf)))
+    f.exact = True
     return f
 
 @sdf3
@@ -201,6 +289,11 @@ def capped_cylinder(a, b, radius):
             -_min(x2, y2),
             np.where(x > 0, x2, 0) + np.where(y > 0, y2, 0))
         return np.sign(d) * np.sqrt(np.abs(d)) / baba
+    # the caps are flat discs, so they only extend perpendicular to the axis
+    e = radius * np.sqrt(np.maximum(1 - _normalize(b - a) ** 2, 0))
+    f.interval = dn._lipschitz(f)
+    f.bounds = (_min(a, b) - e, _max(a, b) + e)
+    f.exact = True
     return f
 
 @sdf3
@@ -212,6 +305,9 @@ def rounded_cylinder(ra, rb, h):
         return (
             _min(_max(d[:,0], d[:,1]), 0) +
             _length(_max(d, 0)) - rb)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.array((-ra, -ra, -h / 2)), np.array((ra, ra, h / 2)))
+    f.exact = True
     return f
 
 @sdf3
@@ -234,6 +330,10 @@ def capped_cone(a, b, ra, rb):
         return s * np.sqrt(_min(
             cax * cax + cay * cay * baba,
             cbx * cbx + cby * cby * baba))
+    r = max(ra, rb)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (_min(a, b) - r, _max(a, b) + r)
+    f.exact = True
     return f
 
 @sdf3
@@ -247,6 +347,10 @@ def rounded_cone(r1, r2, h):
         c2 = _length(q - _vec(0, h)) - r2
         c3 = np.dot(q, _vec(a, b)) - r1
         return np.where(k < 0, c1, np.where(k > a * h, c2, c3))
+    r = max(r1, r2)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (np.array((-r, -r, -r1)), np.array((r, r, h + r2)))
+    f.exact = True
     return f
 
 @sdf3
@@ -256,6 +360,19 @@ def ellipsoid(size):
         k0 = _length(p / size)
         k1 = _length(p / (size * size))
         return k0 * (k0 - 1) / k1
+    def interval(lo, hi):
+        a, b = dn._norm_interval(lo / size, hi / size)
+        c, d = dn._norm_interval(lo / size ** 2, hi / size ** 2)
+        # k0 * (k0 - 1) is smallest at k0 = 0.5
+        n0 = _min(a * (a - 1), b * (b - 1))
+        n0 = np.where((a <= 0.5) & (b >= 0.5), -0.25, n0)
+        n1 = _max(a * (a - 1), b * (b - 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d0 = _min(n0 / c, n0 / d)
+            d1 = _max(n1 / c, n1 / d)
+        return (np.nan_to_num(d0, nan=-np.inf), np.nan_to_num(d1, nan=np.inf))
+    f.interval = interval
+    f.bounds = (-size, size)
     return f
 
 @sdf3
@@ -279,6 +396,21 @@ def pyramid(h):
             _min(qy, -qx * m2 - qy * 0.5) > 0,
             0, _min(a, b))
         return np.sqrt((d2 + qz * qz) / m2) * np.sign(_max(qz, -py))
+    lipschitz = dn._lipschitz(f)
+    def interval(lo, hi):
+        # the distance inside jumps at the base, so each side of it is
+        # bounded separately
+        x0, y0, z0 = lo.T
+        x1, y1, z1 = hi.T
+        a = lipschitz(lo, _vec(x1, y1, _min(z1, 0)))
+        b = lipschitz(_vec(x0, y0, _max(z0, 0)), hi)
+        below = z1 <= 0
+        above = z0 >= 0
+        return (
+            np.where(below, a[0], np.where(above, b[0], _min(a[0], b[0]))),
+            np.where(below, a[1], np.where(above, b[1], _max(a[1], b[1]))))
+    f.interval = interval
+    f.bounds = (np.array((-0.5, -0.5, 0)), np.array((0.5, 0.5, h)))
     return f
 
 # Platonic Solids
@@ -290,12 +422,16 @@ def tetrahedron(r):
         y = p[:,1]
         z = p[:,2]
         return (_max(np.abs(x + y) - z, np.abs(x - y) + z) - r) / np.sqrt(3)
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.full(3, r), np.full(3, r))
     return f
 
 @sdf3
 def octahedron(r):
     def f(p):
         return (np.sum(np.abs(p), axis=1) - r) * np.tan(np.radians(30))
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.full(3, r), np.full(3, r))
     return f
 
 @sdf3
@@ -308,6 +444,8 @@ def dodecahedron(r):
         c = np.dot(p, (y, z, x))
         q = (_max(_max(a, b), c) - x) * r
         return q
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.full(3, r), np.full(3, r))
     return f
 
 @sdf3
@@ -322,6 +460,8 @@ def icosahedron(r):
         c = np.dot(p, (y, z, x))
         d = np.dot(p, (w, w, w)) - x
         return _max(_max(_max(a, b), c) - x, d) * r
+    f.interval = dn._lipschitz(f)
+    f.bounds = (-np.full(3, r), np.full(3, r))
     return f
 
 # Positioning
@@ -330,6 +470,12 @@ def icosahedron(r):
 def translate(other, offset):
     def f(p):
         return other(p - offset)
+    f.bounds = dn._transform_bounds(other.bounds, np.eye(3), offset)
+    f.affine = (np.eye(3), np.zeros(3) - offset, 1)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op3
@@ -342,6 +488,12 @@ def scale(other, factor):
     m = min(x, min(y, z))
     def f(p):
         return other(p / s) * m
+    f.bounds = dn._transform_bounds(other.bounds, np.diag(s))
+    f.affine = (np.diag(1 / np.array(s)), np.zeros(3), m)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op3
@@ -357,6 +509,12 @@ def rotate(other, angle, vector=Z):
     ]).T
     def f(p):
         return other(np.dot(p, matrix))
+    f.bounds = dn._transform_bounds(other.bounds, matrix.T)
+    f.affine = (matrix, np.zeros(3), 1)
+    f.exact = dn._affine_exact(other, *f.affine)
+    f.interval = dn._affine_interval(other, *f.affine)
+    f.grid = dn._affine_grid(other, *f.affine)
+    f.prune = dn._affine_prune(other, *f.affine)
     return f
 
 @op3
@@ -389,6 +547,13 @@ def circular_array(other, count, offset=0):
         d1 = other(_vec(np.cos(a - da) * d, np.sin(a - da) * d, z))
         d2 = other(_vec(np.cos(a) * d, np.sin(a) * d, z))
         return _min(d1, d2)
+    def interval(lo, hi):
+        # both points lie within the wedge between angles -da and da
+        (x0, y0), (x1, y1) = dn._wedge_bounds(lo, hi, da)
+        return dn._interval(other,
+            _vec(x0, y0, lo[:,2]), _vec(x1, y1, hi[:,2]))
+    f.interval = interval
+    f.bounds = dn._radial_bounds(other.bounds)
     return f
 
 # Alterations
@@ -402,6 +567,11 @@ def elongate(other, size):
         z = q[:,2].reshape((-1, 1))
         w = _min(_max(x, _max(y, z)), 0)
         return other(_max(q, 0)) + w
+    f.interval = dn._elongate_interval(other, size)
+    f.bounds = None
+    if other.bounds is not None:
+        r = np.max(np.abs(other.bounds), axis=0) + size
+        f.bounds = (-r, r)
     return f
 
 @op3
@@ -416,6 +586,14 @@ def twist(other, k):
         y2 = s * x + c * y
         z2 = z
         return other(_vec(x2, y2, z2))
+    def interval(lo, hi):
+        a = (_min(k * lo[:,2], k * hi[:,2]), _max(k * lo[:,2], k * hi[:,2]))
+        x, y = dn._rotate_interval(
+            (lo[:,0], hi[:,0]), (lo[:,1], hi[:,1]), a)
+        return dn._interval(other,
+            _vec(x[0], y[0], lo[:,2]), _vec(x[1], y[1], hi[:,2]))
+    f.interval = interval
+    f.bounds = dn._radial_bounds(other.bounds)
     return f
 
 @op3
@@ -430,6 +608,14 @@ def bend(other, k):
         y2 = s * x + c * y
         z2 = z
         return other(_vec(x2, y2, z2))
+    def interval(lo, hi):
+        a = (_min(k * lo[:,0], k * hi[:,0]), _max(k * lo[:,0], k * hi[:,0]))
+        x, y = dn._rotate_interval(
+            (lo[:,0], hi[:,0]), (lo[:,1], hi[:,1]), a)
+        return dn._interval(other,
+            _vec(x[0], y[0], lo[:,2]), _vec(x[1], y[1], hi[:,2]))
+    f.interval = interval
+    f.bounds = dn._radial_bounds(other.bounds)
     return f
 
 @op3
@@ -442,6 +628,14 @@ def bend_linear(other, p0, p1, v, e=ease.linear):
         t = np.clip(np.dot(p - p0, ab) / np.dot(ab, ab), 0, 1)
         t = e(t).reshape((-1, 1))
         return other(p + t * v)
+    t0, t1 = dn._ease_range(e)
+    def interval(lo, hi):
+        return dn._interval(other,
+            lo + _min(t0 * v, t1 * v), hi + _max(t0 * v, t1 * v))
+    f.interval = interval
+    f.bounds = dn._union_bounds(
+        dn._transform_bounds(other.bounds, np.eye(3), -t0 * v),
+        dn._transform_bounds(other.bounds, np.eye(3), -t1 * v))
     return f
 
 @op3
@@ -454,6 +648,14 @@ def bend_radial(other, r0, r1, dz, e=ease.linear):
         t = np.clip((r - r0) / (r1 - r0), 0, 1)
         z = z - dz * e(t)
         return other(_vec(x, y, z))
+    t0, t1 = dn._ease_range(e)
+    def interval(lo, hi):
+        z = Z * _max(dz * t0, dz * t1), Z * _min(dz * t0, dz * t1)
+        return dn._interval(other, lo - z[0], hi - z[1])
+    f.interval = interval
+    f.bounds = dn._union_bounds(
+        dn._transform_bounds(other.bounds, np.eye(3), Z * dz * t0),
+        dn._transform_bounds(other.bounds, np.eye(3), Z * dz * t1))
     return f
 
 @op3
@@ -467,6 +669,15 @@ def transition_linear(f0, f1, p0=-Z, p1=Z, e=ease.linear):
         t = np.clip(np.dot(p - p0, ab) / np.dot(ab, ab), 0, 1)
         t = e(t).reshape((-1, 1))
         return t * d2 + (1 - t) * d1
+    t = dn._ease_range(e)
+    def interval(lo, hi):
+        d1 = dn._interval(f0, lo, hi)
+        d2 = dn._interval(f1, lo, hi)
+        if d1 is None or d2 is None:
+            return None
+        return dn._mix_interval(d1, d2, t)
+    f.interval = interval
+    f.bounds = dn._union_bounds(f0.bounds, f1.bounds)
     return f
 
 @op3
@@ -478,6 +689,15 @@ def transition_radial(f0, f1, r0=0, r1=1, e=ease.linear):
         t = np.clip((r - r0) / (r1 - r0), 0, 1)
         t = e(t).reshape((-1, 1))
         return t * d2 + (1 - t) * d1
+    t = dn._ease_range(e)
+    def interval(lo, hi):
+        d1 = dn._interval(f0, lo, hi)
+        d2 = dn._interval(f1, lo, hi)
+        if d1 is None or d2 is None:
+            return None
+        return dn._mix_interval(d1, d2, t)
+    f.interval = interval
+    f.bounds = dn._union_bounds(f0.bounds, f1.bounds)
     return f
 
 @op3
@@ -499,6 +719,20 @@ def wrap_around(other, x0, x1, r=None, e=ease.linear):
         q = p0 + (p1 - p0) * t + v * d
         q[:,2] = z
         return other(q)
+    t0, t1 = dn._ease_range(e)
+    def interval(lo, hi):
+        d0, d1 = dn._norm_interval(lo[:,:2], hi[:,:2])
+        x = x0 + (x1 - x0) * np.array((t0, t1))
+        one = np.ones(len(lo))
+        return dn._interval(other,
+            _vec(one * x.min(), r - d1, lo[:,2]),
+            _vec(one * x.max(), r - d0, hi[:,2]))
+    f.interval = interval
+    f.bounds = None
+    if other.bounds is not None:
+        (_, y0, z0), (_, _, z1) = other.bounds
+        w = max(r - y0, 0)
+        f.bounds = (np.array((-w, -w, z0)), np.array((w, w, z1)))
     return f
 
 # 3D => 2D Operations
@@ -517,6 +751,15 @@ def slice(other):
         w = A <= 0
         A[w] = B[w]
         return A
+    def interval(lo, hi):
+        # the slice is exactly other at z = 0
+        z = np.zeros((len(lo), 1))
+        return dn._interval(other, np.hstack([lo, z]), np.hstack([hi, z]))
+    f.interval = interval
+    f.bounds = None
+    if other.bounds is not None:
+        lo, hi = other.bounds
+        f.bounds = (lo[:2], hi[:2])
     return f
 
 # Common
@@ -0,0 +1,134 @@
+import itertools
+import numpy as np
+
+# Dual Contouring
+#
+# One vertex is placed in every cell that the surface passes through, at the
+# point that best fits the tangent planes sampled where the surface crosses
+# the cell's edges (the QEF minimizer). Each grid edge crossing the surface
+# then produces a quad connecting the vertices of the four cells around it.
+# Unlike marching cubes, this keeps sharp edges and corners.
+
+SVD_THRESHOLD = 0.1
+
+def _gradient(sdf, p, h):
+    n = len(p)
+    offsets = np.concatenate([np.eye(3) * h, np.eye(3) * -h])
+    q = (p[None,:,:] + offsets[:,None,:]).reshape((-1, 3))
+    d = sdf(q).reshape((6, n))
+    g = (d[:3] - d[3:]).T
+    length = np.linalg.norm(g, axis=1).reshape((-1, 1))
+    return np.divide(g, length, out=np.zeros_like(g), where=length > 0)
+
+def _solve(A, b, c):
+    # minimize |A x - b| near the mass point c, ignoring directions that are
+    # not constrained by the normals (flat regions and edges)
+    w, U = np.linalg.eigh(A)
+    limit = SVD_THRESHOLD * w[:,-1:]
+    inv = np.divide(1, w, out=np.zeros_like(w), where=w > limit)
+    r = b - np.einsum('nij,nj->ni', A, c)
+    r = np.einsum('nji,nj->ni', U, r) * inv
+    return c + np.einsum('nij,nj->ni', U, r)
+
+def dual_contouring(sdf, X, Y, Z, volume, lower=(0, 0, 0)):
+    # returns vertices, faces and the (i, j, k) cell index of each vertex.
+    # faces are only emitted for edges at or beyond `lower` on every axis,
+    # so that batches which overlap by one cell don't duplicate them.
+    grid = (X, Y, Z)
+    step = np.array([a[1] - a[0] for a in grid])
+    shape = np.array(volume.shape)
+    cells = shape - 1
+    inside = volume < 0
+
+    # surface crossings on the edges of each axis
+    edges = []
+    for a in range(3):
+        n = np.array([0, 0, 0])
+        n[a] = 1
+        s0 = tuple(slice(0, m - d) for m, d in zip(shape, n))
+        s1 = tuple(slice(d, m) for m, d in zip(shape, n))
+        w = np.argwhere(inside[s0] != inside[s1])
+        v0 = volume[s0][tuple(w.T)]
+        v1 = volume[s1][tuple(w.T)]
+        t = v0 / (v0 - v1)
+        p = np.stack([g[w[:,i]] for i, g in enumerate(grid)], axis=-1)
+        p[:,a] += t * step[a]
+        edges.append((w, p, v0 < 0))
+
+    points = np.concatenate([p for _, p, _ in edges])
+    if len(points) == 0:
+        empty = np.zeros((0, 3), dtype=int)
+        return np.zeros((0, 3)), empty, empty
+    normals = _gradient(sdf, points, step.min() * 1e-2)
+
+    # accumulate the quadric of every cell around each crossed edge
+    index = []
+    weights = []
+    start = 0
+    for a, (w, p, _) in enumerate(edges):
+        normal = normals[start:start+len(w)]
+        start += len(w)
+        b = (a + 1) % 3
+        c = (a + 2) % 3
+        for du, dv in itertools.product((-1, 0), repeat=2):
+            q = w.copy()
+            q[:,b] += du
+            q[:,c] += dv
+            valid = np.all((q >= 0) & (q < cells), axis=1)
+            index.append(np.ravel_multi_index(q[valid].T, cells))
+            weights.append(_qef_terms(normal[valid], p[valid]))
+    index = np.concatenate(index)
+    weights = np.concatenate(weights)
+    size = cells.prod()
+    sums = np.stack([np.bincount(index, weights[:,i], size)
+        for i in range(weights.shape[1])], axis=-1)
+
+    active = np.flatnonzero(sums[:,-1])
+    sums = sums[active]
+    A = sums[:,[0,1,2,1,3,4,2,4,5]].reshape((-1, 3, 3))
+    b = sums[:,6:9]
+    c = sums[:,9:12] / sums[:,-1:]
+    ijk = np.stack(np.unravel_index(active, cells), axis=-1)
+    x0 = np.stack([g[ijk[:,i]] for i, g in enumerate(grid)], axis=-1)
+    vertices = np.clip(_solve(A, b, c), x0, x0 + step)
+
+    lookup = np.full(size, -1)
+    lookup[active] = np.arange(len(active))
+
+    # one quad per crossed edge, wound so that normals point outward
+    faces = []
+    for a, (w, _, flip) in enumerate(edges):
+        b = (a + 1) % 3
+        c = (a + 2) % 3
+        keep = np.all(w >= lower, axis=1)
+        keep &= (w[:,b] >= 1) & (w[:,b] < cells[b])
+        keep &= (w[:,c] >= 1) & (w[:,c] < cells[c])
+        w = w[keep]
+        flip = flip[keep]
+        quad = []
+        for du, dv in ((-1, -1), (0, -1), (0, 0), (-1, 0)):
+            q = w.copy()
+            q[:,b] += du
+            q[:,c] += dv
+            quad.append(lookup[np.ravel_multi_index(q.T, cells)])
+        quad = np.stack(quad, axis=-1)
+        quad[~flip] = quad[~flip][:,::-1]
+        faces.append(quad[:,[0,1,2]])
+        faces.append(quad[:,[0,2,3]])
+    faces = np.concatenate(faces)
+
+    # drop vertices of cells that only border edges owned by other batches
+    used = np.zeros(len(vertices), dtype=bool)
+    used[faces] = True
+    lookup = np.cumsum(used) - 1
+    return vertices[used], lookup[faces], ijk[used]
+
+def _qef_terms(n, p):
+    d = np.sum(n * p, axis=1)
+    nx, ny, nz = n.T
+    return np.stack([
+        nx * nx, nx * ny, nx * nz, ny * ny, ny * nz, nz * nz,
+        nx * d, ny * d, nz * d,
+        p[:,0], p[:,1], p[:,2],
+        np.ones(len(p)),
+    ], axis=-1)
@@ -0,0 +1,165 @@
+from scipy import sparse
+
+import numpy as np
+import warnings
+
+# Quadric Error Metric Decimation
+#
+# Every vertex carries the sum of the plane quadrics of the faces around it
+# in the original mesh. Edges are collapsed to the point that minimizes the
+# combined quadric of their two vertices. Each pass collapses all edges that
+# are the cheapest in their neighborhood at once, so no two collapses touch
+# the same face and each pass is fully vectorized.
+
+def _plane_quadrics(vertices, faces):
+    a, b, c = (vertices[faces[:,i]] for i in range(3))
+    n = np.cross(b - a, c - a)
+    length = np.linalg.norm(n, axis=1).reshape((-1, 1))
+    n = np.divide(n, length, out=np.zeros_like(n), where=length > 0)
+    p = np.hstack([n, -np.sum(n * a, axis=1).reshape((-1, 1))])
+    k = p[:,:,None] * p[:,None,:]
+    Q = np.zeros((len(vertices), 4, 4))
+    for i in range(3):
+        Q += np.stack([np.bincount(faces[:,i], k[:,r,c], len(vertices))
+            for r in range(4) for c in range(4)], axis=-1).reshape((-1, 4, 4))
+    return Q
+
+def _cost(Q, v):
+    v = np.hstack([v, np.ones((len(v), 1))])
+    return np.maximum(np.einsum('ni,nij,nj->n', v, Q, v), 0)
+
+def _edges(faces, n):
+    e = np.concatenate([faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,0]]])
+    e = np.sort(e, axis=1)
+    e, counts = np.unique(e[:,0] * n + e[:,1], return_counts=True)
+    return np.stack([e // n, e % n], axis=-1), counts
+
+def _flips(vertices, faces, incidence, edges, position):
+    # for every edge, move both endpoints to the new position and check the
+    # normals of the faces around them, other than the two that collapse
+    a, b = edges.T
+    pairs = (incidence[a] + incidence[b]).tocoo()
+    e, f = pairs.row, pairs.col
+    tri = faces[f]
+    removed = np.any(tri == a[e,None], axis=1) & np.any(tri == b[e,None], axis=1)
+    e, tri = e[~removed], tri[~removed]
+    p = vertices[tri]
+    before = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    moved = (tri == a[e,None]) | (tri == b[e,None])
+    p = np.where(moved[:,:,None], position[e][:,None,:], p)
+    after = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    flipped = np.sum(before * after, axis=1) <= 0
+    return np.bincount(e[flipped], minlength=len(edges)) > 0
+
+def decimate(vertices, faces, count=None, error=None, sdf=None):
+    vertices = np.array(vertices, dtype=float)
+    faces = np.array(faces)
+    Q = _plane_quadrics(vertices, faces)
+    n = len(vertices)
+    rng = np.random.default_rng(0)
+
+    while count is None or len(faces) > count:
+        neighbors, counts = _edges(faces, n)
+        adjacency = sparse.coo_matrix(
+            (np.ones(2 * len(neighbors)),
+            (neighbors.reshape(-1), neighbors[:,::-1].reshape(-1))),
+            shape=(n, n)).tocsr()
+
+        # vertices on open boundaries (e.g. where the mesh was clipped by the
+        # sampling bounds) are never moved
+        locked = np.zeros(n, dtype=bool)
+        locked[neighbors[counts != 2].reshape(-1)] = True
+        edges = neighbors[~np.any(locked[neighbors], axis=1)]
+
+        # link condition: the endpoints may only share the two vertices
+        # opposite the edge, or the collapse would pinch the surface
+        a, b = edges.T
+        common = adjacency[a].multiply(adjacency[b]).sum(axis=1)
+        edges = edges[np.asarray(common).reshape(-1) == 2]
+        if len(edges) == 0:
+            break
+        a, b = edges.T
+
+        # candidate positions: the quadric minimizer when it is well defined,
+        # otherwise the better of the endpoints and the midpoint
+        Qe = Q[a] + Q[b]
+        candidates = [vertices[a], vertices[b], (vertices[a] + vertices[b]) / 2]
+        A = Qe[:,:3,:3]
+        ok = np.abs(np.linalg.det(A)) > 1e-12
+        x = np.zeros((len(edges), 3))
+        x[ok] = np.linalg.solve(A[ok], -Qe[ok,:3,3:])[:,:,0]
+        candidates.append(np.where(ok.reshape((-1, 1)), x, candidates[2]))
+        costs = np.stack([_cost(Qe, v) for v in candidates], axis=-1)
+        best = np.argmin(costs, axis=1)
+        position = np.stack(candidates, axis=1)[np.arange(len(edges)), best]
+        cost = costs[np.arange(len(edges)), best]
+        if sdf is not None:
+            cost = np.maximum(cost, sdf(position).reshape(-1) ** 2)
+
+        if error is not None:
+            valid = cost <= error * error
+            edges, position, cost = edges[valid], position[valid], cost[valid]
+            if len(edges) == 0:
+                break
+            a, b = edges.T
+
+        # select a maximal set of collapses that are the cheapest within two
+        # rings of their vertices, so that no face touches two of them. ties
+        # (e.g. on flat regions) are broken randomly to avoid long chains.
+        # collapses that would flip any of the faces around them are skipped
+        incidence = sparse.coo_matrix(
+            (np.ones(faces.size), (faces.reshape(-1), np.repeat(
+            np.arange(len(faces)), 3))), shape=(n, len(faces))).tocsr()
+        rank = np.empty(len(edges), dtype=int)
+        rank[np.lexsort((rng.random(len(edges)), cost))] = np.arange(len(edges))
+        selected = np.zeros(len(edges), dtype=bool)
+        candidate = np.ones(len(edges), dtype=bool)
+        while np.any(candidate):
+            m1 = np.full(n, len(edges))
+            np.minimum.at(m1, a[candidate], rank[candidate])
+            np.minimum.at(m1, b[candidate], rank[candidate])
+            m2 = m1.copy()
+            np.minimum.at(m2, neighbors[:,0], m1[neighbors[:,1]])
+            np.minimum.at(m2, neighbors[:,1], m1[neighbors[:,0]])
+            new = np.flatnonzero(candidate & (rank == m2[a]) & (rank == m2[b]))
+            candidate[new] = False
+            new = new[~_flips(
+                vertices, faces, incidence, edges[new], position[new])]
+            selected[new] = True
+            blocked = np.zeros(n, dtype=bool)
+            blocked[a[new]] = True
+            blocked[b[new]] = True
+            ring = blocked.copy()
+            ring[neighbors[:,0][blocked[neighbors[:,1]]]] = True
+            ring[neighbors[:,1][blocked[neighbors[:,0]]]] = True
+            candidate &= ~(ring[a] | ring[b])
+
+        if count is not None:
+            s = np.flatnonzero(selected)
+            s = s[np.argsort(cost[s], kind='stable')]
+            selected[s[(len(faces) - count + 1) // 2:]] = False
+
+        s = np.flatnonzero(selected)
+        if len(s) == 0:
+            break
+        a, b = edges[s].T
+        vertices[a] = position[s]
+        Q[a] += Q[b]
+        remap = np.arange(n)
+        remap[b] = a
+        faces = remap[faces]
+        faces = faces[
+            (faces[:,0] != faces[:,1]) &
+            (faces[:,1] != faces[:,2]) &
+            (faces[:,2] != faces[:,0])]
+
+    # collapses stop when none of the remaining ones keep the surface
+    # manifold and unflipped, so the count is a best-effort target
+    if count is not None and len(faces) > count:
+        warnings.warn('simplified to %d triangles, not %d' %
+            (len(faces), count))
+
+    used = np.zeros(n, dtype=bool)
+    used[faces] = True
+    index = np.cumsum(used) - 1
+    return vertices[used], index[faces]
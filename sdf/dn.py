@@ -4,111 +4,717 @@ import numpy as np
 _min = np.minimum
 _max = np.maximum
 
-def union(a, *bs, k=None):
-    def f(p):
-        d1 = a(p)
+# unions of at least CULL_CHILDREN children that are evaluated at more than
+# CULL_POINTS points only evaluate each child near the points it can affect
+CULL_CHILDREN = 16
+CULL_POINTS = 512
+CULL_LEVELS = 8
+
+# Bounds
+#
+# Bounds are (lo, hi) pairs of arrays which may contain infinities for
+# unbounded axes. None means that nothing is known about the extent.
+
+def _bounds(f):
+    return getattr(f, 'bounds', None)
+
+def _union_bounds(*bounds):
+    if any(b is None for b in bounds):
+        return None
+    lo = np.min([b[0] for b in bounds], axis=0)
+    hi = np.max([b[1] for b in bounds], axis=0)
+    return (lo, hi)
+
+def _intersection_bounds(*bounds):
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+        return None
+    lo = np.max([b[0] for b in bounds], axis=0)
+    hi = np.min([b[1] for b in bounds], axis=0)
+    return (lo, hi)
+
+def _exact(f):
+    # whether f is the distance to its surface outside of it, which is what
+    # offsetting its bounds by a distance relies on. scaled and approximate
+    # SDFs are smaller than the distance, so their offset surface can reach
+    # past the offset bounds
+    while hasattr(f, 'f'):
+        f = f.f
+    return getattr(f, 'exact', False)
+
+def _affine_exact(other, matrix, offset, factor):
+    # rigid transforms, and uniform scales that multiply the result by the
+    # scale, keep distances exact
+    matrix = np.asarray(matrix, dtype=float)
+    m = np.dot(matrix.T, matrix) * factor ** 2
+    return _exact(other) and np.allclose(m, np.eye(len(m)))
+
+def _expand_bounds(bounds, r):
+    if bounds is None:
+        return None
+    lo, hi = bounds
+    return (lo - r, hi + r)
+
+def _transform_bounds(bounds, matrix, offset=0):
+    # bounds of {q @ matrix + offset} for all q within bounds
+    if bounds is None:
+        return None
+    lo, hi = (np.asarray(b, dtype=float).reshape((-1, 1)) for b in bounds)
+    matrix = np.asarray(matrix, dtype=float)
+    with np.errstate(invalid='ignore'):
+        a = np.where(matrix == 0, 0, lo * matrix)
+        b = np.where(matrix == 0, 0, hi * matrix)
+    lo = np.sum(_min(a, b), axis=0) + offset
+    hi = np.sum(_max(a, b), axis=0) + offset
+    return (lo, hi)
+
+def _halfspace_bounds(normal, point):
+    # the inside of a plane is only bounded if it is axis aligned
+    n = len(normal)
+    lo = np.full(n, -np.inf)
+    hi = np.full(n, np.inf)
+    axes = np.flatnonzero(normal)
+    if len(axes) == 1:
+        i = axes[0]
+        if normal[i] > 0:
+            lo[i] = point[i]
+        else:
+            hi[i] = point[i]
+    return (lo, hi)
+
+def _radial_bounds(bounds, axes=(0, 1)):
+    # bounds of any rotation of bounds about the remaining axis
+    if bounds is None:
+        return None
+    lo, hi = (np.array(b, dtype=float) for b in bounds)
+    i, j = axes
+    r = np.hypot(_max(abs(lo[i]), abs(hi[i])), _max(abs(lo[j]), abs(hi[j])))
+    lo[[i, j]] = -r
+    hi[[i, j]] = r
+    return (lo, hi)
+
+def _ease_range(e):
+    t = e(np.linspace(0, 1, 1001))
+    return t.min(), t.max()
+
+# Intervals
+#
+# f.interval(lo, hi) returns a (lo, hi) pair of arrays that bound the values
+# of f over each of the boxes with corners lo[i] and hi[i]. Exact distance
+# functions change by at most the distance moved, so they are bounded by
+# their value at the center of a box plus or minus its half diagonal.
+# Everything else uses interval arithmetic. None means no interval support.
+
+def _interval(f, lo, hi):
+    interval = getattr(f, 'interval', None)
+    i = interval(lo, hi) if interval is not None else None
+    if i is None:
+        return None
+    return tuple(np.reshape(x, -1) for x in i)
+
+def _lipschitz(f, k=1):
+    def interval(lo, hi):
+        d = f((lo + hi) / 2).reshape(-1)
+        r = k * np.linalg.norm(hi - lo, axis=1) / 2
+        return (d - r, d + r)
+    return interval
+
+def _abs_interval(lo, hi):
+    a = np.where(lo > 0, lo, np.where(hi < 0, -hi, 0))
+    return (a, _max(-lo, hi))
+
+def _norm_interval(lo, hi):
+    a, b = _abs_interval(lo, hi)
+    return (np.linalg.norm(a, axis=-1), np.linalg.norm(b, axis=-1))
+
+def _mul_interval(a, b):
+    with np.errstate(invalid='ignore'):
+        x = np.array(np.broadcast_arrays(
+            a[0] * b[0], a[0] * b[1], a[1] * b[0], a[1] * b[1]))
+    # 0 * inf only comes up at the ends, where 0 is a valid product
+    x[np.isnan(x)] = 0
+    return (x.min(axis=0), x.max(axis=0))
+
+def _mix_interval(a, b, t):
+    # t * b + (1 - t) * a
+    x = _mul_interval(t, b)
+    y = _mul_interval((1 - t[1], 1 - t[0]), a)
+    return (x[0] + y[0], x[1] + y[1])
+
+def _cos_interval(a0, a1):
+    with np.errstate(invalid='ignore'):
+        c0, c1 = np.cos(a0), np.cos(a1)
+    lo, hi = _min(c0, c1), _max(c0, c1)
+    # the range of angles contains a maximum at 2 pi n or a minimum at
+    # pi + 2 pi n
+    n = np.ceil(a0 / (2 * np.pi))
+    hi = np.where(2 * np.pi * n <= a1, 1, hi)
+    n = np.ceil((a0 - np.pi) / (2 * np.pi))
+    lo = np.where(np.pi + 2 * np.pi * n <= a1, -1, lo)
+    return (lo, hi)
+
+def _rotate_interval(x, y, a):
+    # bounds of (x, y) rotated by any angle within a
+    c = _cos_interval(*a)
+    s = _cos_interval(a[0] - np.pi / 2, a[1] - np.pi / 2)
+    cx, cy = _mul_interval(c, x), _mul_interval(c, y)
+    sx, sy = _mul_interval(s, x), _mul_interval(s, y)
+    r = np.hypot(_max(-x[0], x[1]), _max(-y[0], y[1]))
+    x = (_max(cx[0] - sy[1], -r), _min(cx[1] - sy[0], r))
+    y = (_max(sx[0] + cy[0], -r), _min(sx[1] + cy[1], r))
+    return (x, y)
+
+def _wedge_bounds(lo, hi, a):
+    # bounds of the points at the same distance from the z axis as the
+    # boxes, at angles between -a and a
+    r0, r1 = _norm_interval(lo[:,:2], hi[:,:2])
+    c, s = np.cos(a), np.sin(a)
+    x0 = np.where(a >= np.pi, -r1, _min(r0 * c, r1 * c))
+    y1 = np.where(a >= np.pi / 2, r1, r1 * s)
+    return (x0, -y1), (r1, y1)
+
+def _affine_interval(other, matrix, offset, factor):
+    # other over the bounding boxes of the transformed boxes
+    matrix = np.asarray(matrix, dtype=float)
+    def interval(lo, hi):
+        c = np.dot((lo + hi) / 2, matrix) + offset
+        e = np.dot((hi - lo) / 2, np.abs(matrix))
+        d = _interval(other, c - e, c + e)
+        if d is None:
+            return None
+        return _mul_interval(d, (factor, factor))
+    return interval
+
+def _elongate_interval(other, size):
+    def interval(lo, hi):
+        q0, q1 = _abs_interval(lo, hi)
+        q0, q1 = q0 - size, q1 - size
+        d = _interval(other, _max(q0, 0), _max(q1, 0))
+        if d is None:
+            return None
+        w0 = _min(np.max(q0, axis=1), 0)
+        w1 = _min(np.max(q1, axis=1), 0)
+        return (d[0] + w0, d[1] + w1)
+    return interval
+
+def _combine_interval(g, a, bs, k, decreasing=False):
+    # g(d1, d2, K) never decreases with d1, and never decreases with d2
+    # unless decreasing is set, so the ends of the intervals map to the ends
+    # of the result
+    def interval(lo, hi):
+        d = _interval(a, lo, hi)
         for b in bs:
-            d2 = b(p)
+            e = _interval(b, lo, hi)
+            if d is None or e is None:
+                return None
+            if decreasing:
+                e = e[::-1]
             K = k or getattr(b, '_k', None)
-            if K is None:
-                d1 = _min(d1, d2)
-            else:
-                h = np.clip(0.5 + 0.5 * (d2 - d1) / K, 0, 1)
-                m = d2 + (d1 - d2) * h
-                d1 = m - K * h * (1 - h)
-        return d1
+            d = (g(d[0], e[0], K), g(d[1], e[1], K))
+        return d
+    return interval
+
+# Pruning
+#
+# f.prune(lo, hi) returns an equivalent function for points within the box
+# with corners lo and hi (arrays of shape (1, dim)), without the children of
+# unions, intersections and differences that cannot change the result
+# anywhere in the box, or None if nothing could be removed.
+
+def _prune(x, lo, hi):
+    prune = getattr(x, 'prune', None)
+    return x if prune is None else prune(lo, hi)
+
+def _box_interval(x, lo, hi):
+    d = _interval(x, lo, hi)
+    return None if d is None else (d[0].item(), d[1].item())
+
+def _rebuild(op, keep, children, lo, hi, **kwargs):
+    # prunes the children that are left and wraps them in a new op
+    pruned = [_prune(x, lo, hi) for x in keep]
+    if not pruned or pruned == list(children):
+        return None
+    if len(pruned) == 1:
+        return pruned[0]
+    return type(keep[0])(op(*pruned, **kwargs))
+
+def _prune_op(op, other, *args):
+    # for ops that evaluate their child at the same points
+    def prune(lo, hi):
+        x = _prune(other, lo, hi)
+        return None if x is other else type(other)(op(x, *args))
+    return prune
+
+def _affine_prune(other, matrix, offset, factor):
+    matrix = np.asarray(matrix, dtype=float)
+    def prune(lo, hi):
+        c = np.dot((lo + hi) / 2, matrix) + offset
+        e = np.dot((hi - lo) / 2, np.abs(matrix))
+        x = _prune(other, c - e, c + e)
+        if x is other:
+            return None
+        def f(p):
+            return x(np.dot(p, matrix) + offset) * factor
+        return type(other)(f)
+    return prune
+
+# Culling
+#
+# The points are split up into a hierarchy of boxes. Each box drops the
+# children of the union whose intervals show that they can't change the
+# result within it, and boxes with many points and children left are split
+# further. At the end every child is evaluated only at the points of the
+# boxes that kept it.
+
+def _ranges(starts, counts):
+    # concatenated aranges
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum()) + offsets
+
+def _cull(children, ks, g, p):
+    n, dim = p.shape
+    smooth = any(K is not None for K in ks)
+
+    # start with a grid of boxes of about CULL_POINTS points each
+    lo, hi = p.min(axis=0), p.max(axis=0)
+    m = max(int(np.ceil((n / CULL_POINTS) ** (1 / dim))), 1)
+    i = np.clip(((p - lo) / np.where(hi > lo, hi - lo, 1) * m).astype(int),
+        0, m - 1)
+    key = np.ravel_multi_index(i.T, (m,) * dim)
+    idx = np.argsort(key, kind='stable')
+    key = key[idx]
+    starts = np.flatnonzero(np.diff(key, prepend=-1))
+
+    # (box, child) pairs that are still alive, grouped by child
+    cells = len(starts)
+    pc = np.tile(np.arange(cells), len(children))
+    pj = np.repeat(np.arange(len(children)), cells)
+
+    done = []
+    for level in range(CULL_LEVELS):
+        q = p[idx]
+        lo = np.minimum.reduceat(q, starts)
+        hi = np.maximum.reduceat(q, starts)
+        counts = np.diff(np.append(starts, len(idx)))
+        d0 = np.empty(len(pc))
+        d1 = np.empty(len(pc))
+        bounds = np.searchsorted(pj, np.arange(len(children) + 1))
+        for j in range(len(children)):
+            a, b = bounds[j], bounds[j + 1]
+            if a == b:
+                continue
+            d = _interval(children[j], lo[pc[a:b]], hi[pc[a:b]])
+            if d is None:
+                return None
+            d0[a:b], d1[a:b] = d
+        if smooth:
+            # as in prune, a child at least K above the result so far
+            # doesn't change it. the first child is always kept
+            alive = np.ones(len(pc), dtype=bool)
+            r0 = np.full(len(starts), np.inf)
+            r1 = np.full(len(starts), np.inf)
+            r0[pc[:bounds[1]]] = d0[:bounds[1]]
+            r1[pc[:bounds[1]]] = d1[:bounds[1]]
+            for j, K in enumerate(ks, 1):
+                a, b = bounds[j], bounds[j + 1]
+                c = pc[a:b]
+                w = d0[a:b] < r1[c] + (K or 0)
+                alive[a:b] = w
+                c = c[w]
+                r0[c] = g(r0[c], d0[a:b][w], K)
+                r1[c] = g(r1[c], d1[a:b][w], K)
+        else:
+            r1 = np.full(len(starts), np.inf)
+            np.minimum.at(r1, pc, d1)
+            alive = d0 <= r1[pc]
+        pc, pj = pc[alive], pj[alive]
+
+        # boxes with many points and children left are split into octants
+        split = (counts > CULL_POINTS) & (np.bincount(pc, minlength=len(starts)) > 4)
+        if level == CULL_LEVELS - 1:
+            split[:] = False
+        cell = np.repeat(np.arange(len(starts)), counts)
+        s = split[cell]
+        w = ~split[pc]
+        done.append((idx[~s], counts[~split], pc[w], pj[w], split))
+        if not np.any(split):
+            break
+        idx, cell = idx[s], cell[s]
+        center = (lo + hi) / 2
+        code = np.sum((p[idx] > center[cell]) << np.arange(dim), axis=1)
+        key = cell * 2 ** dim + code
+        order = np.argsort(key, kind='stable')
+        idx, key = idx[order], key[order]
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        # every pair of a split box moves to the boxes that it was split into
+        parent = key[starts] >> dim
+        first = np.searchsorted(parent, np.arange(len(split) + 1))
+        pc, pj = pc[~w], pj[~w]
+        size = first[pc + 1] - first[pc]
+        pj = np.repeat(pj, size)
+        pc = _ranges(first[pc], size)
+
+    # number the finished boxes of all levels in order
+    idx = np.concatenate([x[0] for x in done])
+    counts = np.concatenate([x[1] for x in done])
+    offset = np.cumsum([0] + [len(x[1]) for x in done])
+    pc = np.concatenate([
+        offset[i] + np.cumsum(~x[4])[x[2]] - 1 for i, x in enumerate(done)])
+    pj = np.concatenate([x[3] for x in done])
+    order = np.argsort(pj, kind='stable')
+    pc, pj = pc[order], pj[order]
+    starts = np.cumsum(counts) - counts
+    bounds = np.searchsorted(pj, np.arange(len(children) + 1))
+
+    if smooth:
+        d = np.array(children[0](p), dtype=float).reshape(-1)
+    else:
+        d = np.full(len(p), np.inf)
+    for j in range(1 if smooth else 0, len(children)):
+        c = pc[bounds[j]:bounds[j + 1]]
+        if len(c) == 0:
+            continue
+        i = idx[_ranges(starts[c], counts[c])]
+        v = children[j](p[i]).reshape(-1)
+        d[i] = g(d[i], v, ks[j - 1]) if smooth else _min(d[i], v)
+    return d
+
+# Grids
+#
+# f.grid(*axes) evaluates f on the grid spanned by axes, one array per
+# dimension, which broadcast against each other (such as np.ix_(X, Y, Z)).
+# The result broadcasts to the grid, so terms that only depend on some of
+# the axes are computed once per row or column instead of once per point.
+# It may return None, and functions without it are evaluated at the points
+# of the grid.
+
+def _grid(other, axes):
+    f = other.f
+    while hasattr(f, 'f'):
+        f = f.f
+    g = getattr(f, 'grid', None)
+    d = None if g is None else g(*axes)
+    if d is None:
+        shape = np.broadcast_shapes(*(np.shape(a) for a in axes))
+        p = np.stack([np.broadcast_to(a, shape).reshape(-1) for a in axes],
+            axis=-1)
+        d = other(p).reshape(shape)
+    return d
+
+def _affine_grid(other, matrix, offset, factor):
+    # only transforms that map each axis onto a single axis keep the grid
+    matrix = np.asarray(matrix, dtype=float)
+    rows = [np.flatnonzero(c) for c in matrix.T]
+    if any(len(r) != 1 for r in rows):
+        return None
+    rows = [r[0] for r in rows]
+    offset = np.asarray(offset, dtype=float) * np.ones(len(matrix))
+    def grid(*axes):
+        q = [axes[i] * matrix[i, j] + offset[j] for j, i in enumerate(rows)]
+        d = _grid(other, q)
+        return d * factor if factor != 1 else d
+    return grid
+
+def _combine_grid(g, a, bs, k):
+    def grid(*axes):
+        d = _grid(a, axes)
+        for b in bs:
+            d = g(d, _grid(b, axes), k or getattr(b, '_k', None))
+        return d
+    return grid
+
+# Operations
+
+def _fold(g, a, bs, k, p):
+    # the result of the first step is a new array, so the remaining steps
+    # write into it instead of allocating their own
+    d = a(p)
+    out = None
+    for b in bs:
+        d = out = g(d, b(p), k or getattr(b, '_k', None), out)
+    return d
+
+def _smooth_k(k, bs):
+    ks = [k or getattr(b, '_k', None) for b in bs]
+    return max([K for K in ks if K is not None], default=0)
+
+def union(a, *bs, k=None):
+    def g(d1, d2, K, out=None):
+        if K is None:
+            return _min(d1, d2, out=out)
+        h = np.clip(0.5 + 0.5 * (d2 - d1) / K, 0, 1)
+        m = d2 + (d1 - d2) * h
+        return m - K * h * (1 - h)
+    def f(p):
+        if len(bs) >= CULL_CHILDREN - 1 and len(p) > CULL_POINTS:
+            ks = [k or getattr(b, '_k', None) for b in bs]
+            d = _cull((a,) + bs, ks, g, p)
+            if d is not None:
+                return d.reshape((-1, 1))
+        return _fold(g, a, bs, k, p)
+    f.interval = _combine_interval(g, a, bs, k)
+    if len(bs) < CULL_CHILDREN - 1:
+        # large unions cull their children at the points instead
+        f.grid = _combine_grid(g, a, bs, k)
+    def prune(lo, hi):
+        ds = [_box_interval(x, lo, hi) for x in (a,) + bs]
+        if None in ds:
+            return None
+        Ks = [k or getattr(b, '_k', None) for b in bs]
+        if all(K is None for K in Ks):
+            # only children that can be the smallest matter
+            m = min(d[1] for d in ds)
+            keep = [x for x, d in zip((a,) + bs, ds) if d[0] <= m]
+        else:
+            # a child at least K above the result so far doesn't change it
+            keep = [a]
+            d1 = ds[0]
+            for b, d2, K in zip(bs, ds[1:], Ks):
+                if d2[0] >= d1[1] + (K or 0):
+                    continue
+                keep.append(b)
+                d1 = (g(d1[0], d2[0], K), g(d1[1], d2[1], K))
+        return _rebuild(union, keep, (a,) + bs, lo, hi, k=k)
+    f.prune = prune
+    bounds = _union_bounds(*[_bounds(x) for x in (a,) + bs])
+    exact = all(_exact(x) for x in (a,) + bs)
+    f.exact = exact and _smooth_k(k, bs) == 0
+    f.bounds = _expand_bounds(bounds, _smooth_k(k, bs) / 4)
+    if not exact and _smooth_k(k, bs):
+        # smoothing lowers the result by up to k / 4
+        f.bounds = None
     return f
 
 def difference(a, *bs, k=None):
+    def g(d1, d2, K, out=None):
+        if K is None:
+            return _max(d1, np.negative(d2), out=out)
+        h = np.clip(0.5 - 0.5 * (d2 + d1) / K, 0, 1)
+        m = d1 + (-d2 - d1) * h
+        return m + K * h * (1 - h)
     def f(p):
-        d1 = a(p)
-        for b in bs:
-            d2 = b(p)
+        return _fold(g, a, bs, k, p)
+    f.interval = _combine_interval(g, a, bs, k, decreasing=True)
+    f.grid = _combine_grid(g, a, bs, k)
+    def prune(lo, hi):
+        ds = [_box_interval(x, lo, hi) for x in (a,) + bs]
+        if None in ds:
+            return None
+        # a child that is at least K outside of the result so far doesn't
+        # cut anything away from it
+        keep = [a]
+        d1 = ds[0]
+        for b, d2 in zip(bs, ds[1:]):
             K = k or getattr(b, '_k', None)
-            if K is None:
-                d1 = _max(d1, -d2)
-            else:
-                h = np.clip(0.5 - 0.5 * (d2 + d1) / K, 0, 1)
-                m = d1 + (-d2 - d1) * h
-                d1 = m + K * h * (1 - h)
-        return d1
+            if d1[0] + d2[0] >= (K or 0):
+                continue
+            keep.append(b)
+            d1 = (g(d1[0], d2[1], K), g(d1[1], d2[0], K))
+        return _rebuild(difference, keep, (a,) + bs, lo, hi, k=k)
+    f.prune = prune
+    f.bounds = _bounds(a)
     return f
 
 def intersection(a, *bs, k=None):
+    def g(d1, d2, K, out=None):
+        if K is None:
+            return _max(d1, d2, out=out)
+        h = np.clip(0.5 - 0.5 * (d2 - d1) / K, 0, 1)
+        m = d2 + (d1 - d2) * h
+        return m + K * h * (1 - h)
     def f(p):
-        d1 = a(p)
-        for b in bs:
-            d2 = b(p)
-            K = k or getattr(b, '_k', None)
-            if K is None:
-                d1 = _max(d1, d2)
-            else:
-                h = np.clip(0.5 - 0.5 * (d2 - d1) / K, 0, 1)
-                m = d2 + (d1 - d2) * h
-                d1 = m + K * h * (1 - h)
-        return d1
+        return _fold(g, a, bs, k, p)
+    f.interval = _combine_interval(g, a, bs, k)
+    f.grid = _combine_grid(g, a, bs, k)
+    def prune(lo, hi):
+        ds = [_box_interval(x, lo, hi) for x in (a,) + bs]
+        if None in ds:
+            return None
+        Ks = [k or getattr(b, '_k', None) for b in bs]
+        if all(K is None for K in Ks):
+            # only children that can be the largest matter
+            m = max(d[0] for d in ds)
+            keep = [x for x, d in zip((a,) + bs, ds) if d[1] >= m]
+        else:
+            # a child at least K below the result so far doesn't change it
+            keep = [a]
+            d1 = ds[0]
+            for b, d2, K in zip(bs, ds[1:], Ks):
+                if d2[1] <= d1[0] - (K or 0):
+                    continue
+                keep.append(b)
+                d1 = (g(d1[0], d2[0], K), g(d1[1], d2[1], K))
+        return _rebuild(intersection, keep, (a,) + bs, lo, hi, k=k)
+    f.prune = prune
+    f.bounds = _intersection_bounds(*[_bounds(x) for x in (a,) + bs])
     return f
 
 def blend(a, *bs, k=0.5):
+    def g(d1, d2, K, out=None):
+        return K * d2 + (1 - K) * d1
     def f(p):
-        d1 = a(p)
+        return _fold(g, a, bs, k, p)
+    def interval(lo, hi):
+        d = _interval(a, lo, hi)
         for b in bs:
-            d2 = b(p)
+            e = _interval(b, lo, hi)
+            if d is None or e is None:
+                return None
             K = k or getattr(b, '_k', None)
-            d1 = K * d2 + (1 - K) * d1
-        return d1
+            d = _mix_interval(d, e, (K, K))
+        return d
+    f.interval = interval
+    f.grid = _combine_grid(g, a, bs, k)
+    f.bounds = _union_bounds(*[_bounds(x) for x in (a,) + bs])
     return f
 
 def negate(other):
     def f(p):
         return -other(p)
+    def interval(lo, hi):
+        d = _interval(other, lo, hi)
+        return None if d is None else (-d[1], -d[0])
+    f.interval = interval
+    f.grid = lambda *axes: -_grid(other, axes)
+    f.prune = _prune_op(negate, other)
     return f
 
 def dilate(other, r):
     def f(p):
         return other(p) - r
+    def interval(lo, hi):
+        d = _interval(other, lo, hi)
+        return None if d is None else (d[0] - r, d[1] - r)
+    f.interval = interval
+    f.grid = lambda *axes: _grid(other, axes) - r
+    f.prune = _prune_op(dilate, other, r)
+    f.exact = _exact(other)
+    f.bounds = _expand_bounds(_bounds(other), r) if f.exact else None
     return f
 
 def erode(other, r):
     def f(p):
         return other(p) + r
+    def interval(lo, hi):
+        d = _interval(other, lo, hi)
+        return None if d is None else (d[0] + r, d[1] + r)
+    f.interval = interval
+    f.grid = lambda *axes: _grid(other, axes) + r
+    f.prune = _prune_op(erode, other, r)
+    f.bounds = _bounds(other)
     return f
 
 def shell(other, thickness):
     def f(p):
         return np.abs(other(p)) - thickness / 2
+    def interval(lo, hi):
+        d = _interval(other, lo, hi)
+        if d is None:
+            return None
+        d = _abs_interval(*d)
+        return (d[0] - thickness / 2, d[1] - thickness / 2)
+    f.interval = interval
+    f.grid = lambda *axes: np.abs(_grid(other, axes)) - thickness / 2
+    f.prune = _prune_op(shell, other, thickness)
+    f.exact = _exact(other)
+    f.bounds = None
+    if f.exact:
+        f.bounds = _expand_bounds(_bounds(other), thickness / 2)
     return f
 
 def repeat(other, spacing, count=None, padding=0):
     count = np.array(count) if count is not None else None
     spacing = np.array(spacing)
 
-    def neighbors(dim, padding, spacing):
-        try:
-            padding = [padding[i] for i in range(dim)]
-        except Exception:
-            padding = [padding] * dim
-        try:
-            spacing = [spacing[i] for i in range(dim)]
-        except Exception:
-            spacing = [spacing] * dim
-        for i, s in enumerate(spacing):
-            if s == 0:
-                padding[i] = 0
-        axes = [list(range(-p, p + 1)) for p in padding]
-        return list(itertools.product(*axes))
+    cache = {}
 
-    def f(p):
+    def neighbors(dim):
+        # offsets of the neighboring cells to look at, nearest first
+        if dim not in cache:
+            pad = np.array(padding) * np.ones(dim, dtype=int)
+            pad = np.where(spacing * np.ones(dim) == 0, 0, pad).astype(int)
+            n = np.array(list(itertools.product(
+                *[range(-a, a + 1) for a in pad])))
+            cache[dim] = n[np.argsort(np.sum(n * n, axis=1), kind='stable')]
+        return cache[dim]
+
+    def cell(p):
         q = np.divide(p, spacing, out=np.zeros_like(p), where=spacing != 0)
         if count is None:
-            index = np.round(q)
+            return np.round(q)
+        return np.clip(np.round(q), -count, count)
+
+    def lower(u, n):
+        # lower bounds of the neighbors n at the points u (relative to their
+        # own cells), from intervals over boxes of nearby points
+        lo, hi = u.min(axis=0), u.max(axis=0)
+        k = ((u - lo) / np.where(hi > lo, hi - lo, 1) * 8).astype(int)
+        key = np.ravel_multi_index(np.clip(k, 0, 7).T, (8,) * u.shape[-1])
+        key, group = np.unique(key, return_inverse=True)
+        glo = np.full((len(key), u.shape[-1]), np.inf)
+        ghi = np.full((len(key), u.shape[-1]), -np.inf)
+        np.minimum.at(glo, group, u)
+        np.maximum.at(ghi, group, u)
+        bounds = np.empty((len(key), len(n)))
+        for j, o in enumerate(n):
+            d = _interval(other, glo - spacing * o, ghi - spacing * o)
+            if d is None:
+                return None
+            bounds[:,j] = d[0]
+        return bounds[group]
+
+    def f(p):
+        u = p - spacing * cell(p)
+        n = neighbors(p.shape[-1])
+        d = np.array(other(u), dtype=float).reshape(-1)
+        if len(n) == 1:
+            return d
+        # a neighbor only needs to be evaluated at the points that it could
+        # be closer to than the copies seen so far
+        bounds = lower(u, n[1:])
+        for j, o in enumerate(n[1:]):
+            if bounds is None:
+                d = _min(d, other(u - spacing * o).reshape(-1))
+                continue
+            w = np.flatnonzero(bounds[:,j] < d)
+            if len(w):
+                d[w] = _min(d[w], other(u[w] - spacing * o).reshape(-1))
+        return d
+
+    def interval(lo, hi):
+        # every point is at least as far as the nearest copy that any point
+        # of the box looks at, and at most as far as the copy in its own cell
+        i0 = _min(cell(lo), cell(hi))
+        i1 = _max(cell(lo), cell(hi))
+        pad = neighbors(lo.shape[-1]).max(axis=0)
+        size = np.max(i1 - i0, axis=0).astype(int)
+        offsets = list(itertools.product(
+            *[range(-a, b + a + 1) for a, b in zip(pad, size)]))
+        d0 = np.full(len(lo), np.inf)
+        d1 = np.full(len(lo), -np.inf)
+        if len(offsets) > 64:
+            return (-d0, -d1)
+        for o in offsets:
+            i = i0 + o
+            d = _interval(other, lo - spacing * i, hi - spacing * i)
+            if d is None:
+                return None
+            near = np.all(i <= i1 + pad, axis=1)
+            own = np.all((i >= i0) & (i <= i1), axis=1)
+            d0 = np.where(near, _min(d0, d[0]), d0)
+            d1 = np.where(own, _max(d1, d[1]), d1)
+        return (d0, d1)
+
+    f.interval = interval
+
+    f.bounds = None
+    bounds = _bounds(other)
+    if bounds is not None:
+        dim = len(bounds[0])
+        s = np.abs(spacing * np.ones(dim))
+        if count is None:
+            r = np.where(s == 0, 0, np.inf)
         else:
-            index = np.clip(np.round(q), -count, count)
-
-        indexes = [index + n for n in neighbors(p.shape[-1], padding, spacing)]
-        A = [other(p - spacing * i) for i in indexes]
-        a = A[0]
-        for b in A[1:]:
-            a = _min(a, b)
-        return a
+            r = s * (np.abs(count) + np.abs(padding))
+        f.bounds = _expand_bounds(bounds, r)
     return f
@@ -0,0 +1,258 @@
+import collections
+import threading
+
+import numpy as np
+
+from . import d2, d3, dn
+
+# Expression Graph
+#
+# Every SDF built with the decorators in d2.py and d3.py records the function
+# that built it and the arguments it was called with, so a model can be
+# inspected and rebuilt. optimize() rebuilds an equivalent model that is
+# cheaper to evaluate:
+#
+# - chains of translate / scale / rotate / orient are folded into a single
+#   affine transform
+# - identical subtrees are merged, and subtrees used in several places keep
+#   their result for the rest of an evaluation of the whole model, so they
+#   are only evaluated once for the same points
+# - nested hard unions and intersections are flattened into one
+
+Node = collections.namedtuple('Node', ['name', 'func', 'args', 'kwargs'])
+
+# reference to a canonical subtree, along with the smoothing factor (set with
+# .k()) of the object it replaces, since unions and friends read it
+_Ref = collections.namedtuple('_Ref', ['index', 'k'])
+
+def _is_sdf(x):
+    return isinstance(x, (d2.SDF2, d3.SDF3))
+
+def _children(node):
+    return [x for x in node.args + tuple(node.kwargs.values()) if _is_sdf(x)]
+
+def _affine(x):
+    # (matrix, offset, factor) such that
+    # x(p) = child(p @ matrix + offset) * factor
+    if x.node is None:
+        return None
+    return getattr(x.f, 'affine', None)
+
+def _key(x):
+    # hashable value that is equal for equal parameters
+    if isinstance(x, _Ref):
+        return x
+    if isinstance(x, np.ndarray):
+        return (np.ndarray, x.dtype.str, x.shape, x.tobytes())
+    if isinstance(x, (tuple, list)):
+        return (type(x),) + tuple(_key(y) for y in x)
+    if isinstance(x, dict):
+        return (dict,) + tuple((k, _key(x[k])) for k in sorted(x))
+    if x is None or isinstance(x, (bool, int, float, str, np.generic)):
+        return (type(x), x)
+    return (id, id(x))
+
+def _hard(args, kwargs):
+    return set(kwargs) <= {'k'} and kwargs.get('k') is None and \
+        all(a.k is None for a in args[1:])
+
+def _transform(other, matrix, offset, factor):
+    linear = not np.array_equal(matrix, np.eye(len(matrix)))
+    shift = np.any(offset)
+    def f(p):
+        if linear:
+            p = np.dot(p, matrix)
+            if shift:
+                p += offset
+        elif shift:
+            p = p + offset
+        d = other(p)
+        return d * factor if factor != 1 else d
+    inverse = np.linalg.inv(matrix)
+    f.bounds = dn._transform_bounds(
+        other.bounds, inverse, -np.dot(offset, inverse))
+    f.affine = (matrix, offset, factor)
+    f.exact = dn._affine_exact(other, matrix, offset, factor)
+    f.interval = dn._affine_interval(other, matrix, offset, factor)
+    f.grid = dn._affine_grid(other, matrix, offset, factor)
+    f.prune = dn._affine_prune(other, matrix, offset, factor)
+    return type(other)(f, Node(
+        'transform', _transform, (other, matrix, offset, factor), {}))
+
+# results of shared subtrees, per thread, for the evaluation of the model
+# that is in progress
+_evaluation = threading.local()
+
+def _memo(other):
+    # a shared subtree is called with the same arrays by each of its users
+    # while the model is evaluated. those arrays are not modified until the
+    # evaluation is done, so the same array means the same result
+    def f(p):
+        cache = getattr(_evaluation, 'cache', None)
+        if cache is None:
+            return other(p)
+        key = (id(f), id(p))
+        if key not in cache:
+            # keep p, so that its id isn't reused during the evaluation
+            cache[key] = (p, other(p))
+        return cache[key][1]
+    local = threading.local()
+    def prune(lo, hi):
+        # every user of a shared subtree asks for the same box in turn, so
+        # they keep sharing the pruned subtree
+        key = (lo.tobytes(), hi.tobytes())
+        if getattr(local, 'key', None) != key:
+            x = other.prune(lo, hi)
+            local.pruned = None if x is other else _memo(x)
+            local.key = key
+        return local.pruned
+    def grid(*axes):
+        cache = getattr(_evaluation, 'cache', None)
+        if cache is None:
+            return dn._grid(other, axes)
+        key = (id(f),) + tuple(id(a) for a in axes)
+        if key not in cache:
+            cache[key] = (axes, dn._grid(other, axes))
+        return cache[key][1]
+    f.bounds = other.bounds
+    f.interval = other.interval
+    f.prune = prune
+    f.exact = dn._exact(other)
+    f.grid = grid
+    return type(other)(f, Node('memo', _memo, (other,), {}))
+
+def _scope(other):
+    # the root of a model with shared subtrees. the results they keep only
+    # last for one call of the model
+    def evaluate(g, *args):
+        if getattr(_evaluation, 'cache', None) is not None:
+            return g(*args)
+        _evaluation.cache = {}
+        try:
+            return g(*args)
+        finally:
+            _evaluation.cache = None
+    def f(p):
+        return evaluate(other, p)
+    def prune(lo, hi):
+        x = other.prune(lo, hi)
+        return None if x is other else _scope(x)
+    f.bounds = other.bounds
+    f.interval = other.interval
+    f.prune = prune
+    f.exact = dn._exact(other)
+    f.grid = lambda *axes: evaluate(dn._grid, other, axes)
+    return type(other)(f, Node('scope', _scope, (other,), {}))
+
+def optimize(other):
+    index = {}
+    visited = {}
+    entries = []
+    refs = []
+
+    def add(key, entry):
+        if key not in index:
+            index[key] = len(entries)
+            entries.append(entry)
+            refs.append(0)
+            for r in entry[2]:
+                refs[r.index] += 1
+        return index[key]
+
+    def ref(x):
+        return _Ref(visit(x), getattr(x, '_k', None))
+
+    def fold(x):
+        matrix, offset, factor = _affine(x)
+        x = _children(x.node)[0]
+        while True:
+            if _is_sdf(x.f):
+                x = x.f
+                continue
+            a = _affine(x)
+            if a is None:
+                break
+            m, o, k = a
+            matrix, offset = np.dot(matrix, m), np.dot(offset, m) + o
+            factor *= k
+            x = _children(x.node)[0]
+        child = ref(x)
+        matrix = np.asarray(matrix, dtype=float)
+        offset = np.asarray(offset, dtype=float) * np.ones(len(matrix))
+        if np.array_equal(matrix, np.eye(len(matrix))) and \
+                not np.any(offset) and factor == 1:
+            return child.index
+        key = ('transform', child, _key(matrix), _key(offset), _key(factor))
+        return add(key, ('transform', (matrix, offset, factor), [child]))
+
+    def visit(x):
+        if id(x) in visited:
+            return visited[id(x)]
+        node = x.node
+        if _is_sdf(x.f):
+            i = visit(x.f)
+        elif _affine(x) is not None:
+            i = fold(x)
+        elif node is None:
+            i = add(('leaf', id(x.f)), ('leaf', x, []))
+        elif not _children(node):
+            key = ('leaf', id(node.func), _key(node.args), _key(node.kwargs))
+            i = add(key, ('leaf', x, []))
+        else:
+            args = tuple(ref(a) if _is_sdf(a) else a for a in node.args)
+            kwargs = {k: ref(v) if _is_sdf(v) else v
+                for k, v in node.kwargs.items()}
+            children = [a for a in args + tuple(kwargs.values())
+                if isinstance(a, _Ref)]
+            key = ('op', id(node.func), _key(args), _key(kwargs))
+            i = add(key, ('op', (node.func, args, kwargs), children))
+        visited[id(x)] = i
+        return i
+
+    def flatten(func, args):
+        result = []
+        for a in args:
+            kind, data, _ = entries[a.index]
+            if refs[a.index] == 1 and kind == 'op' and data[0] is func and \
+                    _hard(data[1], data[2]):
+                result.extend(flatten(func, data[1]))
+            else:
+                result.append(a)
+        return [result[0]] + [_Ref(a.index, None) for a in result[1:]]
+
+    built = {}
+
+    def build(i):
+        if i in built:
+            return built[i]
+        kind, data, children = entries[i]
+        if kind == 'leaf':
+            s = data
+        elif kind == 'transform':
+            s = _transform(arg(children[0]), *data)
+        else:
+            func, args, kwargs = data
+            flat = (d2.union, d2.intersection, d3.union, d3.intersection)
+            if func in flat and _hard(args, kwargs):
+                args = flatten(func, args)
+            s = func(*[arg(a) for a in args],
+                **{k: arg(v) for k, v in kwargs.items()})
+        if refs[i] > 1:
+            s = _memo(s)
+        built[i] = s
+        return s
+
+    def arg(a):
+        if not isinstance(a, _Ref):
+            return a
+        s = build(a.index)
+        if getattr(s, '_k', None) != a.k:
+            s = type(s)(s.f, s.node)
+            s._k = a.k
+        return s
+
+    result = arg(ref(other))
+    if any(r > 1 for r in refs):
+        result = _scope(result)
+        result._k = getattr(other, '_k', None)
+    return result
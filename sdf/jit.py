@@ -0,0 +1,800 @@
+import inspect
+import math
+import threading
+import types
+
+import numpy as np
+
+from . import d2, d3, graph
+
+# Numba Compilation
+#
+# compile() lowers a tree of built-in primitives and operations into a single
+# numba kernel that evaluates the whole tree one point at a time, so no
+# temporary arrays are allocated along the way. Each node emits a few lines
+# of scalar code into the body of the kernel's loop, with its parameters
+# inlined as constants. Subtrees that can't be compiled (custom SDFs, meshes,
+# text, some easing functions) keep running with NumPy, and their children
+# are compiled on their own. The compiled children of hard unions and
+# intersections are grouped into one kernel.
+
+class _Unsupported(Exception):
+    pass
+
+def _lit(x):
+    x = float(x)
+    if math.isnan(x):
+        return 'math.nan'
+    if math.isinf(x):
+        return 'math.inf' if x > 0 else '-math.inf'
+    return repr(x)
+
+def _vector(x, n):
+    return np.broadcast_to(np.asarray(x, dtype=float), (n,))
+
+def _params(node):
+    a = inspect.signature(node.func).bind(*node.args, **node.kwargs)
+    a.apply_defaults()
+    return a.arguments
+
+# Scalar Primitives
+
+def _length2(x, y):
+    return math.sqrt(x * x + y * y)
+
+def _length3(x, y, z):
+    return math.sqrt(x * x + y * y + z * z)
+
+def _clip(x, a, b):
+    return min(max(x, a), b)
+
+def _sign(x):
+    return 1.0 if x > 0 else -1.0 if x < 0 else 0.0
+
+def _sphere(x, y, z, r, cx, cy, cz):
+    return _length3(x - cx, y - cy, z - cz) - r
+
+def _plane(x, y, z, nx, ny, nz, px, py, pz):
+    return (px - x) * nx + (py - y) * ny + (pz - z) * nz
+
+def _box(x, y, z, sx, sy, sz, cx, cy, cz):
+    qx = abs(x - cx) - sx / 2
+    qy = abs(y - cy) - sy / 2
+    qz = abs(z - cz) - sz / 2
+    return (_length3(max(qx, 0.0), max(qy, 0.0), max(qz, 0.0)) +
+        min(max(qx, max(qy, qz)), 0.0))
+
+def _rounded_box(x, y, z, sx, sy, sz, r):
+    return _box(x, y, z, sx - 2 * r, sy - 2 * r, sz - 2 * r, 0.0, 0.0, 0.0) - r
+
+def _wireframe_edge(a, b, c):
+    return (_length3(max(a, 0.0), max(b, 0.0), max(c, 0.0)) +
+        min(max(a, max(b, c)), 0.0))
+
+def _wireframe_box(x, y, z, sx, sy, sz, t):
+    px = abs(x) - sx / 2 - t / 2
+    py = abs(y) - sy / 2 - t / 2
+    pz = abs(z) - sz / 2 - t / 2
+    qx = abs(px + t / 2) - t / 2
+    qy = abs(py + t / 2) - t / 2
+    qz = abs(pz + t / 2) - t / 2
+    return min(min(
+        _wireframe_edge(px, qy, qz),
+        _wireframe_edge(qx, py, qz)),
+        _wireframe_edge(qx, qy, pz))
+
+def _torus(x, y, z, r1, r2):
+    return _length2(_length2(x, y) - r1, z) - r2
+
+def _capsule(x, y, z, ax, ay, az, bx, by, bz, r):
+    pax, pay, paz = x - ax, y - ay, z - az
+    bax, bay, baz = bx - ax, by - ay, bz - az
+    baba = bax * bax + bay * bay + baz * baz
+    h = _clip((pax * bax + pay * bay + paz * baz) / baba, 0.0, 1.0)
+    return _length3(pax - bax * h, pay - bay * h, paz - baz * h) - r
+
+def _cylinder(x, y, z, r):
+    return _length2(x, y) - r
+
+def _capped_cylinder(x, y, z, ax, ay, az, bx, by, bz, r):
+    bax, bay, baz = bx - ax, by - ay, bz - az
+    pax, pay, paz = x - ax, y - ay, z - az
+    baba = bax * bax + bay * bay + baz * baz
+    paba = pax * bax + pay * bay + paz * baz
+    u = _length3(
+        pax * baba - bax * paba,
+        pay * baba - bay * paba,
+        paz * baba - baz * paba) - r * baba
+    v = abs(paba - baba * 0.5) - baba * 0.5
+    u2 = u * u
+    v2 = v * v * baba
+    if max(u, v) < 0:
+        d = -min(u2, v2)
+    else:
+        d = (u2 if u > 0 else 0.0) + (v2 if v > 0 else 0.0)
+    return _sign(d) * math.sqrt(abs(d)) / baba
+
+def _rounded_cylinder(x, y, z, ra, rb, h):
+    d0 = _length2(x, y) - ra + rb
+    d1 = abs(z) - h / 2 + rb
+    return min(max(d0, d1), 0.0) + _length2(max(d0, 0.0), max(d1, 0.0)) - rb
+
+def _capped_cone(x, y, z, ax, ay, az, bx, by, bz, ra, rb):
+    rba = rb - ra
+    bax, bay, baz = bx - ax, by - ay, bz - az
+    pax, pay, paz = x - ax, y - ay, z - az
+    baba = bax * bax + bay * bay + baz * baz
+    papa = pax * pax + pay * pay + paz * paz
+    paba = (pax * bax + pay * bay + paz * baz) / baba
+    u = math.sqrt(papa - paba * paba * baba)
+    cax = max(0.0, u - (ra if paba < 0.5 else rb))
+    cay = abs(paba - 0.5) - 0.5
+    k = rba * rba + baba
+    f = _clip((rba * (u - ra) + paba * baba) / k, 0.0, 1.0)
+    cbx = u - ra - f * rba
+    cby = paba - f
+    s = -1.0 if cbx < 0 and cay < 0 else 1.0
+    return s * math.sqrt(min(
+        cax * cax + cay * cay * baba,
+        cbx * cbx + cby * cby * baba))
+
+def _rounded_cone(x, y, z, r1, r2, h):
+    qx = _length2(x, y)
+    qy = z
+    b = (r1 - r2) / h
+    a = math.sqrt(1 - b * b)
+    k = qx * -b + qy * a
+    if k < 0:
+        return _length2(qx, qy) - r1
+    if k > a * h:
+        return _length2(qx, qy - h) - r2
+    return qx * a + qy * b - r1
+
+def _ellipsoid(x, y, z, sx, sy, sz):
+    k0 = _length3(x / sx, y / sy, z / sz)
+    k1 = _length3(x / (sx * sx), y / (sy * sy), z / (sz * sz))
+    return k0 * (k0 - 1) / k1
+
+def _pyramid(x, y, z, h):
+    ax = abs(x) - 0.5
+    ay = abs(y) - 0.5
+    if ay > ax:
+        ax, ay = ay, ax
+    px = ax
+    py = z
+    pz = ay
+    m2 = h * h + 0.25
+    qx = pz
+    qy = h * py - 0.5 * px
+    qz = h * px + 0.5 * py
+    s = max(-qx, 0.0)
+    t = _clip((qy - 0.5 * pz) / (m2 + 0.25), 0.0, 1.0)
+    a = m2 * (qx + s) ** 2 + qy * qy
+    b = m2 * (qx + 0.5 * t) ** 2 + (qy - m2 * t) ** 2
+    d2 = 0.0 if min(qy, -qx * m2 - qy * 0.5) > 0 else min(a, b)
+    return math.sqrt((d2 + qz * qz) / m2) * _sign(max(qz, -py))
+
+def _tetrahedron(x, y, z, r):
+    return (max(abs(x + y) - z, abs(x - y) + z) - r) / math.sqrt(3)
+
+def _octahedron(x, y, z, r, k):
+    return (abs(x) + abs(y) + abs(z) - r) * k
+
+def _dodecahedron(x, y, z, r, nx, ny, nz):
+    x, y, z = abs(x / r), abs(y / r), abs(z / r)
+    a = x * nx + y * ny + z * nz
+    b = x * nz + y * nx + z * ny
+    c = x * ny + y * nz + z * nx
+    return (max(max(a, b), c) - nx) * r
+
+def _icosahedron(x, y, z, r, nx, ny, nz, w):
+    x, y, z = abs(x / r), abs(y / r), abs(z / r)
+    a = x * nx + y * ny + z * nz
+    b = x * nz + y * nx + z * ny
+    c = x * ny + y * nz + z * nx
+    d = (x + y + z) * w - nx
+    return max(max(max(a, b), c) - nx, d) * r
+
+def _circle(x, y, r, cx, cy):
+    return _length2(x - cx, y - cy) - r
+
+def _line(x, y, nx, ny, px, py):
+    return (px - x) * nx + (py - y) * ny
+
+def _rectangle(x, y, sx, sy, cx, cy):
+    qx = abs(x - cx) - sx / 2
+    qy = abs(y - cy) - sy / 2
+    return _length2(max(qx, 0.0), max(qy, 0.0)) + min(max(qx, qy), 0.0)
+
+def _rounded_rectangle(x, y, sx, sy, r0, r1, r2, r3):
+    if x > 0:
+        r = r0 if y > 0 else r1
+    else:
+        r = r3 if y > 0 else r2
+    qx = abs(x) - sx / 2 + r
+    qy = abs(y) - sy / 2 + r
+    return (min(max(qx, qy), 0.0) +
+        _length2(max(qx, 0.0), max(qy, 0.0)) - r)
+
+def _equilateral_triangle(x, y):
+    k = math.sqrt(3)
+    px = abs(x) - 1
+    py = y + 1 / k
+    if px + k * py > 0:
+        px, py = (px - k * py) / 2, (-k * px - py) / 2
+    px -= _clip(px, -2.0, 0.0)
+    return -_length2(px, py) * _sign(py)
+
+def _hexagon(x, y, r, kx, ky, kz):
+    px = abs(x)
+    py = abs(y)
+    t = 2 * min(kx * px + ky * py, 0.0)
+    px -= t * kx
+    py -= t * ky
+    px -= _clip(px, -kz * r, kz * r)
+    py -= r
+    return _length2(px, py) * _sign(py)
+
+def _rounded_x(x, y, w, r):
+    x = abs(x)
+    y = abs(y)
+    q = min(x + y, w) * 0.5
+    return _length2(x - q, y - q) - r
+
+def _polygon(x, y, points):
+    n = len(points)
+    d = (x - points[0, 0]) ** 2 + (y - points[0, 1]) ** 2
+    s = 1.0
+    for i in range(n):
+        j = (i + n - 1) % n
+        ex = points[j, 0] - points[i, 0]
+        ey = points[j, 1] - points[i, 1]
+        wx = x - points[i, 0]
+        wy = y - points[i, 1]
+        h = _clip((wx * ex + wy * ey) / (ex * ex + ey * ey), 0.0, 1.0)
+        bx = wx - ex * h
+        by = wy - ey * h
+        d = min(d, bx * bx + by * by)
+        c1 = y >= points[i, 1]
+        c2 = y < points[j, 1]
+        c3 = ex * wy > ey * wx
+        if (c1 and c2 and c3) or not (c1 or c2 or c3):
+            s = -s
+    return s * math.sqrt(d)
+
+def _vesica(x, y, r, d):
+    x = abs(x)
+    y = abs(y)
+    b = math.sqrt(r * r - d * d)
+    if (y - b) * d > x * b:
+        return _length2(x, y - b)
+    return _length2(x + d, y) - r
+
+def _extrude(d, z, h):
+    w = abs(z) - h / 2
+    return min(max(d, w), 0.0) + _length2(max(d, 0.0), max(w, 0.0))
+
+def _ratio(p, a, b):
+    # clamped position of p along a..b, given as matching coordinate lists
+    ab = b - a
+    return ' + '.join('(%s - %s) * %s' % (x, _lit(u), _lit(v / np.dot(ab, ab)))
+        for x, u, v in zip(p, a, ab))
+
+# Node Handlers
+#
+# Each handler emits the code for one node, given its bound arguments and the
+# variables holding the coordinates of the point, and returns the variable
+# holding its distance.
+
+def _primitives():
+    return {
+        d3.sphere: lambda a: (_sphere, a['radius'], _vector(a['center'], 3)),
+        d3.plane: lambda a: (_plane, d3._normalize(a['normal']), a['point']),
+        d3.box: lambda a: (
+            _box, _vector(a['size'], 3), _vector(a['center'], 3)),
+        d3.rounded_box: lambda a: (
+            _rounded_box, _vector(a['size'], 3), a['radius']),
+        d3.wireframe_box: lambda a: (
+            _wireframe_box, _vector(a['size'], 3), a['thickness']),
+        d3.torus: lambda a: (_torus, a['r1'], a['r2']),
+        d3.capsule: lambda a: (_capsule, a['a'], a['b'], a['radius']),
+        d3.cylinder: lambda a: (_cylinder, a['radius']),
+        d3.capped_cylinder: lambda a: (
+            _capped_cylinder, a['a'], a['b'], a['radius']),
+        d3.rounded_cylinder: lambda a: (
+            _rounded_cylinder, a['ra'], a['rb'], a['h']),
+        d3.capped_cone: lambda a: (
+            _capped_cone, a['a'], a['b'], a['ra'], a['rb']),
+        d3.rounded_cone: lambda a: (_rounded_cone, a['r1'], a['r2'], a['h']),
+        d3.ellipsoid: lambda a: (_ellipsoid, _vector(a['size'], 3)),
+        d3.pyramid: lambda a: (_pyramid, a['h']),
+        d3.tetrahedron: lambda a: (_tetrahedron, a['r']),
+        d3.octahedron: lambda a: (
+            _octahedron, a['r'], np.tan(np.radians(30))),
+        d3.dodecahedron: lambda a: (_dodecahedron, a['r'],
+            d3._normalize(((1 + np.sqrt(5)) / 2, 1, 0))),
+        d3.icosahedron: lambda a: (_icosahedron, a['r'] * 0.8506507174597755,
+            d3._normalize(((np.sqrt(5) + 3) / 2, 1, 0)), np.sqrt(3) / 3),
+        d2.circle: lambda a: (_circle, a['radius'], _vector(a['center'], 2)),
+        d2.line: lambda a: (_line, d2._normalize(a['normal']), a['point']),
+        d2.rectangle: lambda a: (
+            _rectangle, _vector(a['size'], 2), _vector(a['center'], 2)),
+        d2.rounded_rectangle: lambda a: (_rounded_rectangle,
+            _vector(a['size'], 2), _vector(a['radius'], 4)),
+        d2.equilateral_triangle: lambda a: (_equilateral_triangle,),
+        d2.hexagon: lambda a: (_hexagon, a['r'] * 3 ** 0.5 / 2,
+            3 ** 0.5 / -2, 0.5, np.tan(np.pi / 6)),
+        d2.rounded_x: lambda a: (_rounded_x, a['w'], a['r']),
+        d2.vesica: lambda a: (_vesica, a['r'], a['d']),
+    }
+
+def _polygon_handler(c, x, a, p):
+    points = c.constant(np.array(a['points'], dtype=float).reshape((-1, 2)))
+    return c.call(_polygon, *p, points)
+
+def _affine_handler(c, x, a, p):
+    matrix, offset, factor = x.f.affine
+    matrix = np.asarray(matrix, dtype=float)
+    offset = _vector(offset, len(p))
+    q = []
+    for j in range(len(p)):
+        terms = ['%s * %s' % (_lit(matrix[i, j]), p[i])
+            for i in range(len(p)) if matrix[i, j] != 0]
+        if offset[j] != 0:
+            terms.append(_lit(offset[j]))
+        q.append(c.assign(' + '.join(terms) or '0.0'))
+    d = c.emit(graph._children(x.node)[0], q)
+    return d if factor == 1 else c.assign('%s * %s' % (d, _lit(factor)))
+
+def _memo_handler(c, x, a, p):
+    return c.emit(a['other'], p)
+
+def _union_handler(c, x, a, p):
+    d1 = c.emit(a['a'], p)
+    for b in a['bs']:
+        d2 = c.emit(b, p)
+        K = a['k'] or getattr(b, '_k', None)
+        if K is None:
+            d1 = c.assign('min(%s, %s)' % (d1, d2))
+        else:
+            K = _lit(K)
+            h = c.assign('_clip(0.5 + 0.5 * (%s - %s) / %s, 0.0, 1.0)' % (
+                d2, d1, K))
+            m = c.assign('%s + (%s - %s) * %s' % (d2, d1, d2, h))
+            d1 = c.assign('%s - %s * %s * (1 - %s)' % (m, K, h, h))
+    return d1
+
+def _difference_handler(c, x, a, p):
+    d1 = c.emit(a['a'], p)
+    for b in a['bs']:
+        d2 = c.emit(b, p)
+        K = a['k'] or getattr(b, '_k', None)
+        if K is None:
+            d1 = c.assign('max(%s, -%s)' % (d1, d2))
+        else:
+            K = _lit(K)
+            h = c.assign('_clip(0.5 - 0.5 * (%s + %s) / %s, 0.0, 1.0)' % (
+                d2, d1, K))
+            m = c.assign('%s + (-%s - %s) * %s' % (d1, d2, d1, h))
+            d1 = c.assign('%s + %s * %s * (1 - %s)' % (m, K, h, h))
+    return d1
+
+def _intersection_handler(c, x, a, p):
+    d1 = c.emit(a['a'], p)
+    for b in a['bs']:
+        d2 = c.emit(b, p)
+        K = a['k'] or getattr(b, '_k', None)
+        if K is None:
+            d1 = c.assign('max(%s, %s)' % (d1, d2))
+        else:
+            K = _lit(K)
+            h = c.assign('_clip(0.5 - 0.5 * (%s - %s) / %s, 0.0, 1.0)' % (
+                d2, d1, K))
+            m = c.assign('%s + (%s - %s) * %s' % (d2, d1, d2, h))
+            d1 = c.assign('%s + %s * %s * (1 - %s)' % (m, K, h, h))
+    return d1
+
+def _blend_handler(c, x, a, p):
+    d1 = c.emit(a['a'], p)
+    for b in a['bs']:
+        d2 = c.emit(b, p)
+        K = a['k'] or getattr(b, '_k', None)
+        if K is None:
+            raise _Unsupported
+        d1 = c.assign('%s * %s + (1 - %s) * %s' % (
+            _lit(K), d2, _lit(K), d1))
+    return d1
+
+def _negate_handler(c, x, a, p):
+    return c.assign('-%s' % c.emit(a['other'], p))
+
+def _dilate_handler(c, x, a, p):
+    return c.assign('%s - %s' % (c.emit(a['other'], p), _lit(a['r'])))
+
+def _erode_handler(c, x, a, p):
+    return c.assign('%s + %s' % (c.emit(a['other'], p), _lit(a['r'])))
+
+def _shell_handler(c, x, a, p):
+    return c.assign('abs(%s) - %s' % (
+        c.emit(a['other'], p), _lit(a['thickness'] / 2)))
+
+def _repeat_handler(c, x, a, p):
+    n = len(p)
+    spacing = _vector(a['spacing'], n)
+    count = a['count']
+    padding = _vector(a['padding'], n).astype(int)
+    padding[spacing == 0] = 0
+    index = []
+    for i in range(n):
+        if spacing[i] == 0:
+            index.append('0.0')
+            continue
+        q = c.assign('np.rint(%s / %s)' % (p[i], _lit(spacing[i])))
+        if count is not None:
+            k = _lit(_vector(count, n)[i])
+            q = c.assign('_clip(%s, -%s, %s)' % (q, k, k))
+        index.append(q)
+    neighbors = np.stack(np.meshgrid(
+        *[np.arange(-r, r + 1) for r in padding], indexing='ij'), axis=-1)
+    neighbors = c.constant(neighbors.reshape((-1, n)).astype(float))
+    d = c.assign('math.inf')
+    j = c.var()
+    c.begin('for %s in range(len(%s)):' % (j, neighbors))
+    q = [c.assign('%s - %s * (%s + %s[%s, %d])' % (
+        p[i], _lit(spacing[i]), index[i], neighbors, j, i))
+        for i in range(n)]
+    c.line('%s = min(%s, %s)' % (d, d, c.emit(a['other'], q)))
+    c.end()
+    return d
+
+def _elongate_handler(c, x, a, p):
+    size = _vector(a['size'], len(p))
+    q = [c.assign('abs(%s) - %s' % (u, _lit(s))) for u, s in zip(p, size)]
+    w = q[0]
+    for u in q[1:]:
+        w = c.assign('max(%s, %s)' % (w, u))
+    w = c.assign('min(%s, 0.0)' % w)
+    d = c.emit(a['other'], [c.assign('max(%s, 0.0)' % u) for u in q])
+    return c.assign('%s + %s' % (d, w))
+
+def _twist_handler(c, x, a, p):
+    t = c.assign('%s * %s' % (_lit(a['k']), p[2]))
+    return _rotate_xy(c, a['other'], p, t)
+
+def _bend_handler(c, x, a, p):
+    t = c.assign('%s * %s' % (_lit(a['k']), p[0]))
+    return _rotate_xy(c, a['other'], p, t)
+
+def _rotate_xy(c, other, p, t):
+    x, y, z = p
+    cos = c.assign('math.cos(%s)' % t)
+    sin = c.assign('math.sin(%s)' % t)
+    return c.emit(other, [
+        c.assign('%s * %s - %s * %s' % (cos, x, sin, y)),
+        c.assign('%s * %s + %s * %s' % (sin, x, cos, y)),
+        z])
+
+def _circular_array_handler(c, x, a, p):
+    x, y, z = p
+    da = 2 * np.pi / a['count']
+    offset = _lit(a['offset'])
+    d = c.assign('math.hypot(%s, %s)' % (x, y))
+    t = c.assign('math.atan2(%s, %s) %% %s' % (y, x, _lit(da)))
+    u = c.assign('%s - %s' % (t, _lit(da)))
+    d1 = c.emit(a['other'], [
+        c.assign('math.cos(%s) * %s - %s' % (u, d, offset)),
+        c.assign('math.sin(%s) * %s' % (u, d)), z])
+    d2 = c.emit(a['other'], [
+        c.assign('math.cos(%s) * %s - %s' % (t, d, offset)),
+        c.assign('math.sin(%s) * %s' % (t, d)), z])
+    return c.assign('min(%s, %s)' % (d1, d2))
+
+def _circular_array2_handler(c, x, a, p):
+    x, y = p
+    count = a['count']
+    padding = a['padding']
+    da = 2 * np.pi / count
+    d = c.assign('math.hypot(%s, %s)' % (x, y))
+    t = c.assign('math.atan2(%s, %s) %% %s' % (y, x, _lit(da)))
+    ds = []
+    for j in list(range(-padding, padding + 2))[:count]:
+        u = c.assign('%s - %s' % (t, _lit(j * da)))
+        ds.append(c.emit(a['other'], [
+            c.assign('math.cos(%s) * %s' % (u, d)),
+            c.assign('math.sin(%s) * %s' % (u, d))]))
+    result = ds[0]
+    for e in ds[1:]:
+        result = c.assign('min(%s, %s)' % (result, e))
+    return result
+
+def _bend_linear_handler(c, x, a, p):
+    p0 = np.array(a['p0'], dtype=float)
+    p1 = np.array(a['p1'], dtype=float)
+    v = -np.array(a['v'], dtype=float)
+    t = c.assign('_clip(%s, 0.0, 1.0)' % _ratio(p, p0, p1))
+    t = c.assign('%s(%s)' % (c.ease(a['e']), t))
+    return c.emit(a['other'], [
+        c.assign('%s + %s * %s' % (u, t, _lit(w))) for u, w in zip(p, v)])
+
+def _bend_radial_handler(c, x, a, p):
+    x, y, z = p
+    r0, r1 = a['r0'], a['r1']
+    r = c.assign('math.hypot(%s, %s)' % (x, y))
+    t = c.assign('_clip((%s - %s) / %s, 0.0, 1.0)' % (
+        r, _lit(r0), _lit(r1 - r0)))
+    t = c.assign('%s(%s)' % (c.ease(a['e']), t))
+    return c.emit(a['other'], [x, y,
+        c.assign('%s - %s * %s' % (z, _lit(a['dz']), t))])
+
+def _transition(c, a, p, t):
+    d1 = c.emit(a['f0'], p)
+    d2 = c.emit(a['f1'], p)
+    t = c.assign('%s(%s)' % (c.ease(a['e']), t))
+    return c.assign('%s * %s + (1 - %s) * %s' % (t, d2, t, d1))
+
+def _transition_linear_handler(c, x, a, p):
+    p0 = np.array(a['p0'], dtype=float)
+    p1 = np.array(a['p1'], dtype=float)
+    t = c.assign('_clip(%s, 0.0, 1.0)' % _ratio(p, p0, p1))
+    return _transition(c, a, p, t)
+
+def _transition_radial_handler(c, x, a, p):
+    r0, r1 = a['r0'], a['r1']
+    r = c.assign('math.hypot(%s, %s)' % (p[0], p[1]))
+    t = c.assign('_clip((%s - %s) / %s, 0.0, 1.0)' % (
+        r, _lit(r0), _lit(r1 - r0)))
+    return _transition(c, a, p, t)
+
+def _wrap_around_handler(c, x, a, p):
+    x, y, z = p
+    x0, x1, r = a['x0'], a['x1'], a['r']
+    if r is None:
+        r = abs(x1 - x0) / (2 * np.pi)
+    d = c.assign('math.hypot(%s, %s) - %s' % (x, y, _lit(r)))
+    t = c.assign('(math.atan2(%s, %s) + math.pi) / (2 * math.pi)' % (y, x))
+    t = c.assign('%s(%s)' % (c.ease(a['e']), t))
+    return c.emit(a['other'], [
+        c.assign('%s + %s * %s' % (_lit(x0), _lit(x1 - x0), t)),
+        c.assign('-%s' % d), z])
+
+def _extrude_handler(c, x, a, p):
+    d = c.emit(a['other'], p[:2])
+    return c.call(_extrude, d, p[2], a['h'])
+
+def _extrude_to_handler(c, x, a, p):
+    d1 = c.emit(a['a'], p[:2])
+    d2 = c.emit(a['b'], p[:2])
+    t = c.assign('_clip(%s / %s, -0.5, 0.5) + 0.5' % (p[2], _lit(a['h'])))
+    t = c.assign('%s(%s)' % (c.ease(a['e']), t))
+    d = c.assign('%s + (%s - %s) * %s' % (d1, d2, d1, t))
+    return c.call(_extrude, d, p[2], a['h'])
+
+def _revolve_handler(c, x, a, p):
+    x, y, z = p
+    q = c.assign('_length2(%s, %s) - %s' % (x, y, _lit(a['offset'])))
+    return c.emit(a['other'], [q, z])
+
+def _handlers():
+    return {
+        d2.polygon: _polygon_handler,
+        graph._memo: _memo_handler,
+        graph._scope: _memo_handler,
+        d3.union: _union_handler,
+        d3.difference: _difference_handler,
+        d3.intersection: _intersection_handler,
+        d3.blend: _blend_handler,
+        d3.negate: _negate_handler,
+        d3.dilate: _dilate_handler,
+        d3.erode: _erode_handler,
+        d3.shell: _shell_handler,
+        d3.repeat: _repeat_handler,
+        d3.elongate: _elongate_handler,
+        d3.twist: _twist_handler,
+        d3.bend: _bend_handler,
+        d3.circular_array: _circular_array_handler,
+        d3.bend_linear: _bend_linear_handler,
+        d3.bend_radial: _bend_radial_handler,
+        d3.transition_linear: _transition_linear_handler,
+        d3.transition_radial: _transition_radial_handler,
+        d3.wrap_around: _wrap_around_handler,
+        d2.circular_array: _circular_array2_handler,
+        d2.union: _union_handler,
+        d2.difference: _difference_handler,
+        d2.intersection: _intersection_handler,
+        d2.blend: _blend_handler,
+        d2.negate: _negate_handler,
+        d2.dilate: _dilate_handler,
+        d2.erode: _erode_handler,
+        d2.shell: _shell_handler,
+        d2.repeat: _repeat_handler,
+        d2.elongate: _elongate_handler,
+        d2.extrude: _extrude_handler,
+        d2.extrude_to: _extrude_to_handler,
+        d2.revolve: _revolve_handler,
+    }
+
+# Code Generation
+
+_SCALAR = (
+    _length2, _length3, _clip, _sign, _sphere, _plane, _box, _rounded_box,
+    _wireframe_edge, _wireframe_box, _torus, _capsule, _cylinder,
+    _capped_cylinder,
+    _rounded_cylinder, _capped_cone, _rounded_cone, _ellipsoid, _pyramid,
+    _tetrahedron, _octahedron, _dodecahedron, _icosahedron, _circle, _line,
+    _rectangle, _rounded_rectangle, _equilateral_triangle, _hexagon,
+    _rounded_x, _polygon, _vesica, _extrude,
+)
+
+_namespace = None
+_eases = {}
+
+def _functions(numba):
+    # jitted copies of the scalar functions, which refer to each other
+    global _namespace
+    if _namespace is None:
+        namespace = {'math': math, 'np': np}
+        for f in _SCALAR:
+            namespace[f.__name__] = numba.njit(error_model='numpy')(
+                types.FunctionType(f.__code__, namespace, f.__name__))
+        _namespace = namespace
+    return _namespace
+
+class _Context:
+    def __init__(self, numba):
+        self.numba = numba
+        self.namespace = dict(_functions(numba), prange=numba.prange)
+        self.primitives = _primitives()
+        self.handlers = _handlers()
+        self.lines = []
+        self.indent = 2
+        self.count = 0
+        self.emitted = {}
+        self.saved = []
+
+    def var(self):
+        self.count += 1
+        return 'v%d' % self.count
+
+    def line(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def assign(self, expr):
+        v = self.var()
+        self.line('%s = %s' % (v, expr))
+        return v
+
+    def begin(self, line):
+        self.line(line)
+        self.indent += 1
+        self.saved.append(dict(self.emitted))
+
+    def end(self):
+        self.indent -= 1
+        self.emitted = self.saved.pop()
+
+    def constant(self, value):
+        self.count += 1
+        name = 'c%d' % self.count
+        self.namespace[name] = value
+        return name
+
+    def call(self, f, *args):
+        values = []
+        for x in args:
+            if isinstance(x, str):
+                values.append(x)
+            else:
+                values.extend(_lit(v) for v in np.ravel(x))
+        return self.assign('%s(%s)' % (f.__name__, ', '.join(values)))
+
+    def ease(self, e):
+        if e not in _eases:
+            try:
+                _eases[e] = self.numba.njit(error_model='numpy')(e)
+                _eases[e](0.5)
+            except Exception:
+                _eases[e] = None
+        if _eases[e] is None:
+            raise _Unsupported
+        return self.constant(_eases[e])
+
+    def emit(self, x, p):
+        key = (id(x), tuple(p))
+        if key not in self.emitted:
+            self.emitted[key] = self._emit(x, p)
+        return self.emitted[key]
+
+    def _emit(self, x, p):
+        while graph._is_sdf(x.f):
+            x = x.f
+        node = x.node
+        if node is None:
+            raise _Unsupported
+        if node.func in self.primitives:
+            f, *args = self.primitives[node.func](_params(node))
+            return self.call(f, *p, *args)
+        if getattr(x.f, 'affine', None) is not None:
+            return _affine_handler(self, x, None, p)
+        if node.func in self.handlers:
+            return self.handlers[node.func](self, x, _params(node), p)
+        raise _Unsupported
+
+def _compile(numba, other):
+    c = _Context(numba)
+    n = 3 if isinstance(other, d3.SDF3) else 2
+    p = ['p%d' % i for i in range(n)]
+    for i in range(n):
+        c.line('p%d = p[i, %d]' % (i, i))
+    d = c.emit(other, p)
+    c.line('out[i] = %s' % d)
+    source = '\n'.join([
+        'def kernel(p, out):',
+        '    for i in prange(len(p)):',
+    ] + c.lines)
+    exec(source, c.namespace)
+    kernel = numba.njit(parallel=True, error_model='numpy')(
+        c.namespace['kernel'])
+    kernel(np.zeros((1, n)), np.zeros(1))
+
+    # numba's default threading layer doesn't allow launching kernels from
+    # several threads at once. the kernel uses all cores by itself anyway
+    lock = threading.Lock()
+    def f(p):
+        p = np.ascontiguousarray(p, dtype=np.float64)
+        out = np.empty(len(p))
+        with lock:
+            kernel(p, out)
+        return out
+    f.bounds = other.bounds
+    f.interval = other.interval
+    return type(other)(f, graph.Node('compile', compile, (other,), {}))
+
+def _supported(numba, other):
+    # whether the whole tree can be lowered, without compiling it
+    c = _Context(numba)
+    n = 3 if isinstance(other, d3.SDF3) else 2
+    try:
+        c.emit(other, ['p%d' % i for i in range(n)])
+    except _Unsupported:
+        return False
+    return True
+
+def _grouped(numba, node):
+    # a hard union or intersection with some children that can't be
+    # compiled. the others are combined first, so they become one kernel
+    # instead of one each
+    flat = (d2.union, d2.intersection, d3.union, d3.intersection)
+    if node.func not in flat or node.kwargs.get('k') is not None or \
+            set(node.kwargs) - {'k'} or \
+            any(getattr(x, '_k', None) is not None for x in node.args[1:]):
+        return None
+    ok = [x for x in node.args if _supported(numba, x)]
+    if len(ok) < 2:
+        return None
+    rest = [compile(x) for x in node.args if not any(x is y for y in ok)]
+    return node.func(compile(node.func(*ok)), *rest)
+
+def compile(other):
+    import numba
+    k = getattr(other, '_k', None)
+    try:
+        result = _compile(numba, other)
+    except _Unsupported:
+        # evaluate this node with numpy, and compile its children instead
+        if graph._is_sdf(other.f):
+            result = compile(other.f)
+        elif other.node is None or not graph._children(other.node):
+            result = other
+        else:
+            node = other.node
+            result = _grouped(numba, node)
+            if result is None:
+                result = node.func(
+                    *[compile(x) if graph._is_sdf(x) else x
+                        for x in node.args],
+                    **{key: compile(v) if graph._is_sdf(v) else v
+                        for key, v in node.kwargs.items()})
+    if getattr(result, '_k', None) != k:
+        result = type(result)(result.f, result.node)
+        result._k = k
+    return result
@@ -1,10 +1,27 @@
-from scipy import interpolate
-
 import numpy as np
 import threading
 
+from . import dn
 from .d3 import sdf3, box
 
+# level set samples are kept in bricks of BRICK_SIZE voxels per axis, and
+# copied from the grid BRICK_REGION bricks per axis at a time
+BRICK_SIZE = 8
+BRICK_REGION = 8
+
+# triangles per leaf of the bounding volume hierarchy
+LEAF_SIZE = 8
+
+# queries keep at most BVH_PAIRS (point, node) pairs, by taking as few points
+# at a time as needed, and load the triangles of BVH_LEAVES (point, leaf)
+# pairs at a time
+BVH_PAIRS = 2 ** 20
+BVH_LEAVES = 2 ** 14
+
+# winding numbers use the dipole approximation for nodes that are farther
+# than WINDING_ACCURACY times their radius
+WINDING_ACCURACY = 2
+
 # TODO: allow transforming mesh
 class Mesh:
     @classmethod
@@ -62,7 +79,14 @@ class Mesh:
         return self.positioned((0, 0, 0), (0.5, 0.5, 0.5))
 
     @sdf3
-    def sdf(self, voxel_size, half_width=None):
+    def sdf(self, voxel_size=None, half_width=None, method='vdb'):
+        if method == 'bvh':
+            return _bvh_sdf(self.points, self.triangles)
+        if method != 'vdb':
+            raise ValueError('unknown method: %r' % (method,))
+        if voxel_size is None:
+            raise ValueError('voxel_size is required')
+
         import pyopenvdb as vdb
 
         a, b = self.bounding_box
@@ -82,32 +106,300 @@ class Mesh:
         v0, v1 = grid.evalActiveVoxelBoundingBox()
         ijk0 = np.array(v0, dtype=int)
         ijk1 = np.array(v1, dtype=int)
-        size = ijk1 - ijk0 + 1
-
-        p0 = grid.transform.indexToWorld(ijk0)
-        p1 = grid.transform.indexToWorld(ijk1)
-        X = np.linspace(p0[0], p1[0], size[0])
-        Y = np.linspace(p0[1], p1[1], size[1])
-        Z = np.linspace(p0[2], p1[2], size[2])
-
-        A = np.zeros(size, dtype=np.float32)
-        grid.copyToArray(A, ijk=ijk0)
-
-        interpolator = interpolate.RegularGridInterpolator(
-            (X, Y, Z), A, bounds_error=False, fill_value=grid.background)
-
-        # num_voxels = size[0] * size[1] * size[2]
-        # print('mesh voxels = %d' % num_voxels)
+        bricks = _Bricks(grid, ijk0, ijk1)
 
         def f(p):
             e = estimator(p)
-            d = interpolator(p).reshape((-1, 1))
+            d = bricks(p / voxel_size).reshape((-1, 1))
             return np.where(e > grid.background, e, d)
 
-        f.array = A
-        f.xyz = (X, Y, Z)
-        f.grid = grid
-        f.interpolator = interpolator
+        # trilinear level set values change by up to a voxel per voxel
+        # along each axis
+        f.bounds = (np.array(a), np.array(b))
+        f.interval = dn._lipschitz(f, np.sqrt(3))
+        f.bricks = bricks
+        f.vdb_grid = grid
         f.estimator = estimator
 
         return f
+
+# Bricks
+#
+# Bricks have one extra voxel on the high side of every axis so that
+# interpolation never needs a neighboring brick, and only bricks with a
+# value other than +/- the background are kept. Bricks are found by
+# searching their sorted keys, which number the bricks along x first.
+# Empty bricks between two kept bricks in the same row along x are all
+# inside or all outside, which is known from the extra voxels of the kept
+# brick before them.
+
+class _Bricks:
+    def __init__(self, grid, ijk0, ijk1):
+        n = BRICK_SIZE
+        m = BRICK_REGION
+        background = grid.background
+        self.background = background
+        self.b0 = ijk0 // n
+        self.shape = ijk1 // n - self.b0 + 1
+        keys = []
+        bricks = []
+        for k in range(0, self.shape[2], m):
+            for j in range(0, self.shape[1], m):
+                for i in range(0, self.shape[0], m):
+                    start = np.array((i, j, k))
+                    count = np.minimum(m, self.shape - start)
+                    a = np.empty(count * n + 1, dtype=np.float32)
+                    grid.copyToArray(a, ijk=tuple((self.b0 + start) * n))
+                    w = np.lib.stride_tricks.sliding_window_view(
+                        a, (n + 1,) * 3)[::n, ::n, ::n]
+                    active = np.any(np.abs(w) < background, axis=(3, 4, 5))
+                    x, y, z = np.nonzero(active)
+                    keys.append(self._key(np.stack([x, y, z]) +
+                        start[:,None]))
+                    bricks.append(w[x, y, z])
+        keys = np.concatenate(keys)
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.bricks = np.concatenate(bricks)[order]
+        self.inside = self.bricks[:,n,0,0] < 0
+
+    def _key(self, b):
+        sx, sy, _ = self.shape
+        return (b[2] * sy + b[1]) * sx + b[0]
+
+    def __call__(self, x):
+        # level set values at points x in index space
+        n = BRICK_SIZE
+        i = np.floor(x).astype(int)
+        t = x - i
+        b = i // n - self.b0
+        i -= (b + self.b0) * n
+        ok = np.all((b >= 0) & (b < self.shape), axis=1)
+        key = self._key(b.T)
+        k = np.searchsorted(self.keys, key, side='right') - 1
+        c = self.keys[np.maximum(k, 0)]
+        row = ok & (k >= 0) & (c // self.shape[0] == key // self.shape[0])
+        found = row & (c == key)
+        inside = row & self.inside[np.maximum(k, 0)]
+        d = np.where(inside, -self.background, self.background)
+
+        # trilinear interpolation within the bricks
+        k, i, t = k[found], i[found], t[found]
+        u = 1 - t
+        r = 0
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    v = self.bricks[k, i[:,0] + dx, i[:,1] + dy, i[:,2] + dz]
+                    r = r + v * (t[:,0] if dx else u[:,0]) * \
+                        (t[:,1] if dy else u[:,1]) * (t[:,2] if dz else u[:,2])
+        d[found] = r
+        return d
+
+# Bounding Volume Hierarchy
+#
+# Triangles are sorted along a Morton curve and grouped into leaves of
+# LEAF_SIZE triangles. The leaves are padded to a power of two, so the tree
+# is complete and stored as a heap: the children of node i are 2i+1 and
+# 2i+2, and leaf j is node leaves-1+j. Queries walk the tree one level at a
+# time for all (point, node) pairs that are still alive.
+
+def _morton(q):
+    # interleave the bits of three 10 bit integer coordinates
+    code = np.zeros(len(q), dtype=np.int64)
+    for i in range(10):
+        for j in range(3):
+            code |= ((q[:,j] >> i) & 1) << (3 * i + j)
+    return code
+
+def _bvh(points, triangles):
+    tri = np.asarray(points, dtype=float)[np.asarray(triangles)]
+    n = len(tri)
+    if n == 0:
+        raise ValueError('mesh has no triangles')
+    centroid = tri.mean(axis=1)
+    lo, hi = centroid.min(axis=0), centroid.max(axis=0)
+    q = ((centroid - lo) / np.where(hi > lo, hi - lo, 1) * 1023).astype(int)
+    tri = tri[np.argsort(_morton(q), kind='stable')]
+
+    # padding triangles are degenerate, so they add no area or winding
+    leaves = 2 ** int(np.ceil(np.log2(max(-(-n // LEAF_SIZE), 1))))
+    pad = leaves * LEAF_SIZE - n
+    tri = np.concatenate([tri, np.repeat(tri[:1,:1], 3, axis=1).repeat(pad, 0)])
+    valid = (np.arange(len(tri)) < n).reshape((leaves, LEAF_SIZE, 1, 1))
+    t = tri.reshape((leaves, LEAF_SIZE, 3, 3))
+
+    # leaf bounds, area vectors, area weighted centers and radii
+    lo = np.where(valid, t, np.inf).min(axis=(1, 2))
+    hi = np.where(valid, t, -np.inf).max(axis=(1, 2))
+    a = 0.5 * np.cross(t[:,:,1] - t[:,:,0], t[:,:,2] - t[:,:,0])
+    area = np.linalg.norm(a, axis=-1)
+    normal = a.sum(axis=1)
+    weight = area.sum(axis=1)
+    center = np.where(weight[:,None] > 0,
+        np.sum(area[...,None] * t.mean(axis=2), axis=1) /
+        np.where(weight > 0, weight, 1)[:,None], t[:,0,0])
+    radius = np.where(valid[...,0],
+        np.linalg.norm(t - center[:,None,None], axis=-1), 0).max(axis=(1, 2))
+    # a point on the surface, whose distance bounds the distance to a node
+    vertex = t[:,0,0]
+
+    # parents, up to the root
+    levels = [(lo, hi, normal, weight, center, radius, vertex)]
+    while len(lo) > 1:
+        empty = np.isinf(lo[1::2,0])
+        vertex = np.where(empty[:,None], vertex[0::2], vertex[1::2])
+        lo = lo.reshape((-1, 2, 3)).min(axis=1)
+        hi = hi.reshape((-1, 2, 3)).max(axis=1)
+        normal = normal.reshape((-1, 2, 3)).sum(axis=1)
+        w = weight.reshape((-1, 2))
+        c = center.reshape((-1, 2, 3))
+        weight = w.sum(axis=1)
+        center = np.where(weight[:,None] > 0,
+            np.sum(w[...,None] * c, axis=1) /
+            np.where(weight > 0, weight, 1)[:,None],
+            c.mean(axis=1))
+        radius = np.max(np.linalg.norm(c - center[:,None], axis=-1) +
+            radius.reshape((-1, 2)), axis=1)
+        far = np.maximum(np.abs(lo - center), np.abs(hi - center))
+        radius = np.where(np.isinf(lo[:,0]), 0,
+            np.minimum(radius, np.linalg.norm(far, axis=-1)))
+        levels.append((lo, hi, normal, weight, center, radius, vertex))
+    # vectors are stored with their components first, which is much faster
+    # to work with than a short last axis
+    nodes = [np.concatenate(x).T.copy() for x in zip(*reversed(levels))]
+    return np.ascontiguousarray(t.transpose(2, 3, 0, 1)), nodes
+
+def _sub(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def _dot3(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def _cross3(a, b):
+    return (a[1] * b[2] - a[2] * b[1],
+        a[2] * b[0] - a[0] * b[2],
+        a[0] * b[1] - a[1] * b[0])
+
+def _segment_distance(ap, ab):
+    # squared distance from p to a segment, given p - a and b - a
+    ee = _dot3(ab, ab)
+    h = np.clip(_dot3(ap, ab) / np.where(ee > 0, ee, 1), 0, 1)
+    d = (ap[0] - ab[0] * h, ap[1] - ab[1] * h, ap[2] - ab[2] * h)
+    return _dot3(d, d)
+
+def _triangle_distance(p, t):
+    # squared distance from p to triangles t, broadcast together
+    a, b, c = t
+    ab, bc, ca = _sub(b, a), _sub(c, b), _sub(a, c)
+    ap, bp, cp = _sub(p, a), _sub(p, b), _sub(p, c)
+    n = _cross3(ab, _sub(c, a))
+    nn = _dot3(n, n)
+    inside = (nn > 0) & \
+        (_dot3(_cross3(ab, ap), n) >= 0) & \
+        (_dot3(_cross3(bc, bp), n) >= 0) & \
+        (_dot3(_cross3(ca, cp), n) >= 0)
+    plane = _dot3(ap, n) ** 2 / np.where(nn > 0, nn, 1)
+    edges = np.minimum(np.minimum(
+        _segment_distance(ap, ab), _segment_distance(bp, bc)),
+        _segment_distance(cp, ca))
+    return np.where(inside, plane, edges)
+
+def _solid_angle(p, t):
+    # solid angle of triangles t seen from p, broadcast together
+    a, b, c = [_sub(x, p) for x in t]
+    la = np.sqrt(_dot3(a, a))
+    lb = np.sqrt(_dot3(b, b))
+    lc = np.sqrt(_dot3(c, c))
+    det = _dot3(a, _cross3(b, c))
+    den = la * lb * lc + _dot3(a, b) * lc + _dot3(b, c) * la + \
+        _dot3(c, a) * lb
+    return 2 * np.arctan2(det, den)
+
+def _box_distance(p, lo, hi):
+    d = np.maximum(np.maximum(lo - p, p - hi), 0)
+    return _dot3(d, d)
+
+def _bvh_distance(t, nodes, p):
+    lo, hi = nodes[:2]
+    leaves = t.shape[2]
+    depth = int(np.log2(leaves))
+
+    # the leaf found by always taking the nearer child gives an upper bound
+    node = np.zeros(p.shape[1], dtype=int)
+    for _ in range(depth):
+        l = 2 * node + 1
+        closer = _box_distance(p, lo[:,l], hi[:,l]) <= \
+            _box_distance(p, lo[:,l + 1], hi[:,l + 1])
+        node = np.where(closer, l, l + 1)
+    best = np.full(p.shape[1], np.inf)
+    _leaf_distance(t, p, np.arange(p.shape[1]), node, best)
+
+    # nodes that are farther than the best distance so far are skipped
+    vertex = nodes[6]
+    i = np.arange(p.shape[1])
+    node = np.zeros(len(i), dtype=int)
+    for level in range(depth + 1):
+        q = p[:,i]
+        d = _sub(vertex[:,node], q)
+        np.minimum.at(best, i, _dot3(d, d))
+        alive = _box_distance(q, lo[:,node], hi[:,node]) <= best[i]
+        i, node = i[alive], node[alive]
+        if level < depth:
+            i = np.repeat(i, 2)
+            node = (2 * node[:,None] + (1, 2)).reshape(-1)
+    _leaf_distance(t, p, i, node, best)
+    return np.sqrt(best)
+
+def _leaf_distance(t, p, i, node, best):
+    # squared distances from points i to the triangles of leaf nodes
+    leaves = t.shape[2]
+    for j in range(0, len(i), BVH_LEAVES):
+        k = i[j:j+BVH_LEAVES]
+        leaf = t[:,:,node[j:j+BVH_LEAVES] - leaves + 1]
+        d = _triangle_distance(p[:,k,None], leaf).min(axis=1)
+        np.minimum.at(best, k, d)
+
+def _bvh_winding(t, nodes, p):
+    # generalized winding number. nodes that are far enough away are
+    # approximated by a dipole at their center
+    normal, _, center, radius = nodes[2:6]
+    leaves = t.shape[2]
+    depth = int(np.log2(leaves))
+    n = p.shape[1]
+    w = np.zeros(n)
+    i = np.arange(n)
+    node = np.zeros(n, dtype=int)
+    for level in range(depth + 1):
+        r = _sub(center[:,node], p[:,i])
+        d = np.sqrt(_dot3(r, r))
+        far = d > WINDING_ACCURACY * radius[node]
+        x = _dot3(normal[:,node], r)[far] / d[far] ** 3
+        w += np.bincount(i[far], weights=x, minlength=n)
+        i, node = i[~far], node[~far]
+        if level < depth:
+            i = np.repeat(i, 2)
+            node = (2 * node[:,None] + (1, 2)).reshape(-1)
+    for j in range(0, len(i), BVH_LEAVES):
+        k = i[j:j+BVH_LEAVES]
+        leaf = t[:,:,node[j:j+BVH_LEAVES] - leaves + 1]
+        x = _solid_angle(p[:,k,None], leaf).sum(axis=1)
+        w += np.bincount(k, weights=x, minlength=n)
+    return w / (4 * np.pi)
+
+def _bvh_sdf(points, triangles):
+    t, nodes = _bvh(points, triangles)
+    # every point can reach every leaf
+    n = max(1, min(BVH_LEAVES, BVH_PAIRS // t.shape[2]))
+    def f(p):
+        p = np.ascontiguousarray(p.T)
+        d = np.empty(p.shape[1])
+        for i in range(0, p.shape[1], n):
+            q = p[:,i:i+n]
+            e = _bvh_distance(t, nodes, q)
+            d[i:i+n] = np.where(_bvh_winding(t, nodes, q) > 0.5, -e, e)
+        return d
+    points = np.asarray(points)
+    f.bounds = (points.min(axis=0), points.max(axis=0))
+    f.interval = dn._lipschitz(f)
+    return f
@@ -19,6 +19,8 @@ class Bar(object):
 
     @property
     def percent_complete(self):
+        if self.max_value == self.min_value:
+            return 100
         t = (self.value - self.min_value) / (self.max_value - self.min_value)
         return t * 100
 
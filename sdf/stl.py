@@ -1,24 +1,46 @@
 import numpy as np
 import struct
 
-def write_binary_stl(path, points):
-    n = len(points) // 3
+_dtype = np.dtype([
+    ('normal', ('<f', 3)),
+    ('points', ('<f', (3, 3))),
+    ('attr', '<H'),
+])
 
+def _records(points):
     points = np.array(points, dtype='float32').reshape((-1, 3, 3))
     normals = np.cross(points[:,1] - points[:,0], points[:,2] - points[:,0])
     normals /= np.linalg.norm(normals, axis=1).reshape((-1, 1))
 
-    dtype = np.dtype([
-        ('normal', ('<f', 3)),
-        ('points', ('<f', (3, 3))),
-        ('attr', '<H'),
-    ])
-
-    a = np.zeros(n, dtype=dtype)
+    a = np.zeros(len(points), dtype=_dtype)
     a['points'] = points
     a['normal'] = normals
+    return a
+
+def write_binary_stl(path, points):
+    with BinarySTLWriter(path) as writer:
+        writer.write(points)
+
+class BinarySTLWriter(object):
+
+    def __init__(self, path):
+        self.count = 0
+        self.fp = open(path, 'wb')
+        self.fp.write(b'\x00' * 80)
+        self.fp.write(struct.pack('<I', 0))
+
+    def write(self, points):
+        a = _records(points)
+        self.fp.write(a.tobytes())
+        self.count += len(a)
+
+    def close(self):
+        self.fp.seek(80)
+        self.fp.write(struct.pack('<I', self.count))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
 
-    with open(path, 'wb') as fp:
-        fp.write(b'\x00' * 80)
-        fp.write(struct.pack('<I', n))
-        fp.write(a.tobytes())
+    def __exit__(self, *args):
+        self.close()
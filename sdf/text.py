@@ -1,13 +1,23 @@
 from PIL import Image, ImageFont, ImageDraw
 import scipy.ndimage as nd
 import numpy as np
+import hashlib
+import os
 
-from . import d2
+from . import d2, dn
+
+_min = np.minimum
+_max = np.maximum
 
 # TODO: add support for newlines?
 
 PIXELS = 2 ** 22
 
+# distance textures are cached in CACHE_DIR, which is kept below CACHE_SIZE
+# bytes by removing the least recently used ones. None disables the cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sdf')
+CACHE_SIZE = 2 ** 30
+
 def _load_image(thing):
     if isinstance(thing, str):
         return Image.open(thing)
@@ -53,35 +63,102 @@ def text(font_name, text, width=None, height=None, pixels=PIXELS, points=512):
     th = y1 - y0 + 1 + py * 2
 
     # render text to image
-    im = Image.new('L', (tw, th))
-    draw = ImageDraw.Draw(im)
-    draw.text((px - x0, py - y0), text, font=font, fill=255)
+    def render():
+        im = Image.new('L', (tw, th))
+        draw = ImageDraw.Draw(im)
+        draw.text((px - x0, py - y0), text, font=font, fill=255)
+        return im
 
-    return _sdf(width, height, pixels, px, py, im)
+    key = ('text', _file_hash(font.path), text, points, pixels)
+    return _sdf(width, height, pixels, px, py, (tw, th), render, key)
 
 @d2.sdf2
 def image(thing, width=None, height=None, pixels=PIXELS):
     im = _load_image(thing).convert('L')
-    return _sdf(width, height, pixels, 0, 0, im)
+    data = hashlib.sha256(im.tobytes()).hexdigest()
+    key = ('image', im.size, data, pixels)
+    return _sdf(width, height, pixels, 0, 0, im.size, lambda: im, key)
+
+def _file_hash(path):
+    if not isinstance(path, (str, bytes, os.PathLike)) or \
+            not os.path.isfile(path):
+        return repr(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2 ** 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cached(key, compute):
+    # memory-mapped texture from the cache, or compute and store it
+    if CACHE_DIR is None:
+        return compute()
+    name = hashlib.sha256(repr(key).encode()).hexdigest() + '.npy'
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        texture = np.load(path, mmap_mode='r')
+        os.utime(path)
+        return texture
+    except (OSError, ValueError):
+        pass
+    texture = compute()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            np.save(fp, texture)
+        os.replace(tmp, path)
+        _evict(CACHE_DIR, CACHE_SIZE)
+    except OSError:
+        pass
+    return texture
+
+def _evict(path, size):
+    # remove the least recently used textures until the cache fits
+    entries = []
+    for e in os.scandir(path):
+        if e.name.endswith('.npy'):
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(x[1] for x in entries)
+    for _, n, p in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+        total -= n
+
+def _distance_texture(im):
+    a = np.array(im.convert('1'))
+    inside = -nd.distance_transform_edt(a)
+    outside = nd.distance_transform_edt(~a)
+    texture = np.zeros(a.shape, dtype='float32')
+    texture[a] = inside[a]
+    texture[~a] = outside[~a]
+    return texture
 
-def _sdf(width, height, pixels, px, py, im):
-    tw, th = im.size
+def _sdf(width, height, pixels, px, py, size, render, key):
+    tw, th = size
 
     # downscale image if necessary
     factor = (pixels / (tw * th)) ** 0.5
     if factor < 1:
         tw, th = int(round(tw * factor)), int(round(th * factor))
         px, py = int(round(px * factor)), int(round(py * factor))
-        im = im.resize((tw, th))
 
     # convert to numpy array and apply distance transform
-    im = im.convert('1')
-    a = np.array(im)
-    inside = -nd.distance_transform_edt(a)
-    outside = nd.distance_transform_edt(~a)
-    texture = np.zeros(a.shape)
-    texture[a] = inside[a]
-    texture[~a] = outside[~a]
+    def compute():
+        im = render()
+        if factor < 1:
+            im = im.resize((tw, th))
+        return _distance_texture(im)
+
+    texture = _cached(key, compute)
 
     # save debug image
     # a = np.abs(texture)
@@ -105,9 +182,9 @@ def _sdf(width, height, pixels, px, py, im):
     x1 = width / 2
     y1 = height / 2
 
-    # scale texture distances
+    # texture distances are scaled when sampled, since the cached texture
+    # is read only
     scale = width / tw
-    texture *= scale
 
     # prepare fallback rectangle
     # TODO: reduce size based on mesh resolution instead of dividing by 2
@@ -121,14 +198,136 @@ def _sdf(width, height, pixels, px, py, im):
         v = 1 - v
         i = u * pw + px
         j = v * ph + py
-        d = _bilinear_interpolate(texture, i, j)
+        d = _bilinear_interpolate(texture, i, j) * scale
         q = rectangle(p).reshape(-1)
         outside = (i < 0) | (i >= tw-1) | (j < 0) | (j >= th-1)
         d[outside] = q[outside]
         return d
 
+    # bilinear texture distances change by up to two texels per texel
+    # along each axis, where the inside and outside distances meet
+    k = 2 * np.hypot(pw / width, ph / height) * scale
+
+    def interval(lo, hi):
+        # texel positions of the box, with j increasing downwards
+        ia = (lo[:,0] - x0) / width * pw + px
+        ib = (hi[:,0] - x0) / width * pw + px
+        ja = (1 - (hi[:,1] - y0) / height) * ph + py
+        jb = (1 - (lo[:,1] - y0) / height) * ph + py
+        # the texture part is bounded from the nearest texel position to
+        # the center of the box
+        i, j = (ia + ib) / 2, (ja + jb) / 2
+        ci = np.clip(i, 0, np.nextafter(tw - 1, 0))
+        cj = np.clip(j, 0, np.nextafter(th - 1, 0))
+        e = np.hypot((ci - i) * width / pw, (cj - j) * height / ph)
+        r = k * (e + np.linalg.norm(hi - lo, axis=1) / 2)
+        d = _bilinear_interpolate(texture, ci, cj) * scale
+        near = (ib >= 0) & (ia < tw - 1) & (jb >= 0) & (ja < th - 1)
+        a = np.where(near, d - r, np.inf)
+        b = np.where(near, d + r, -np.inf)
+        # and the fallback rectangle, which is exact, the rest
+        leaves = (ia < 0) | (ib >= tw - 1) | (ja < 0) | (jb >= th - 1)
+        qa, qb = dn._interval(rectangle, lo, hi)
+        a = np.where(leaves, _min(a, qa), a)
+        b = np.where(leaves, _max(b, qb), b)
+        return (a, b)
+
+    f.bounds = (np.array((x0, y0)), np.array((x1, y1)))
+    f.interval = interval
     return f
 
+@d2.sdf2
+def glyph_text(font_name, text, width=None, height=None, points=512):
+    # load font file
+    font = ImageFont.truetype(font_name, points)
+    key = ('glyph', _file_hash(font.path), points)
+
+    # distances are only known within pad pixels of each glyph
+    pad = points // 4
+
+    # lay out glyphs using the advances and kerning of the font. each glyph
+    # has a distance texture that is computed once at this size
+    textures = {}
+    glyphs = []
+    x = 0
+    for i, c in enumerate(text):
+        if i:
+            x += font.getlength(text[i-1:i+1]) - font.getlength(c)
+        if c not in textures:
+            textures[c] = _glyph_texture(font, key, c, pad)
+        if textures[c] is not None:
+            texture, x0, y0 = textures[c]
+            glyphs.append((texture, x + x0, y0))
+    if not glyphs:
+        raise ValueError('text has no visible glyphs')
+
+    # ink bounds in font pixels, which map to the world bounds
+    gx0 = min(g[1] for g in glyphs) + pad
+    gy0 = min(g[2] for g in glyphs) + pad
+    gx1 = max(g[1] + g[0].shape[1] - 1 for g in glyphs) - pad
+    gy1 = max(g[2] + g[0].shape[0] - 1 for g in glyphs) - pad
+    aspect = (gx1 - gx0) / (gy1 - gy0)
+    if width is None and height is None:
+        height = 1
+    if width is None:
+        width = height * aspect
+    if height is None:
+        height = width / aspect
+    scale = width / (gx1 - gx0)
+    sy = height / (gy1 - gy0)
+
+    def f(p):
+        u = gx0 + (p[:,0] + width / 2) / scale
+        v = gy1 - (p[:,1] + height / 2) / sy
+        # away from every glyph the distance is at least pad, and at least
+        # the distance to the ink bounds
+        dx = _max(gx0 - u, u - gx1)
+        dy = _max(gy0 - v, v - gy1)
+        d = _max(np.hypot(_max(dx, 0), _max(dy, 0)), pad)
+        # points only sample the glyphs whose texture covers them
+        order = np.argsort(u, kind='stable')
+        su = u[order]
+        for texture, x0, y0 in glyphs:
+            th, tw = texture.shape
+            a = np.searchsorted(su, x0, side='left')
+            # half-open, since the last texel has nothing to interpolate to
+            b = np.searchsorted(su, x0 + tw - 1, side='left')
+            i = order[a:b]
+            i = i[(v[i] >= y0) & (v[i] < y0 + th - 1)]
+            s = _bilinear_interpolate(texture, u[i] - x0, v[i] - y0)
+            d[i] = _min(d[i], s)
+        return d * scale
+
+    # bilinear texture distances change by up to two texels per texel
+    # along each axis, and the textures meet the fallback to within about
+    # a texel
+    lipschitz = dn._lipschitz(f, 2 * np.hypot(1, scale / sy))
+
+    def interval(lo, hi):
+        a, b = lipschitz(lo, hi)
+        return (a - scale, b + scale)
+
+    x0, y0 = -width / 2, -height / 2
+    f.bounds = (np.array((x0, y0)), np.array((-x0, -y0)))
+    f.interval = interval
+    return f
+
+def _glyph_texture(font, key, c, pad):
+    # distance texture of one glyph and the font pixel of its first texel,
+    # relative to the pen position
+    x0, y0, x1, y1 = font.getbbox(c)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    tw = x1 - x0 + 1 + pad * 2
+    th = y1 - y0 + 1 + pad * 2
+    def compute():
+        im = Image.new('L', (tw, th))
+        draw = ImageDraw.Draw(im)
+        draw.text((pad - x0, pad - y0), c, font=font, fill=255)
+        return _distance_texture(im)
+    texture = _cached(key + (c, pad), compute)
+    return texture, x0 - pad, y0 - pad
+
 def _bilinear_interpolate(a, x, y):
     x0 = np.floor(x).astype(int)
     x1 = x0 + 1
@@ -0,0 +1,25 @@
+import numpy as np
+
+from sdf import ellipsoid, sphere
+
+def _extent(f):
+    points = f.generate(step=0.05, verbose=False)
+    return points.min(axis=0), points.max(axis=0)
+
+def test_dilate_scaled_sphere():
+    # the scaled sphere is not an exact SDF, so the dilated surface reaches
+    # past its bounds plus the radius
+    lo, hi = _extent(sphere(0.5).scale((3, 0.5, 0.5)).dilate(0.5))
+    assert np.allclose(lo, (-4.5, -0.75, -0.75), atol=0.05)
+    assert np.allclose(hi, (4.5, 0.75, 0.75), atol=0.05)
+
+def test_dilate_ellipsoid():
+    lo, hi = _extent(ellipsoid((1, 0.3, 0.2)).dilate(0.5))
+    assert lo[0] < -2 and hi[0] > 2
+
+def test_dilate_sphere_bounds():
+    f = sphere(1).dilate(0.5)
+    lo, hi = f.bounds
+    assert np.allclose(lo, -1.5) and np.allclose(hi, 1.5)
+    lo, hi = _extent(f)
+    assert np.allclose(lo, -1.5, atol=0.05) and np.allclose(hi, 1.5, atol=0.05)